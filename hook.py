@@ -1,25 +1,72 @@
 #!/usr/bin/env python
+import sys
+
+# with --async on the command line, requests are served by greenlets, and
+# blocking functions of the standard library are made cooperative before
+# any other module uses them
+#
+cooperative = __name__ == "__main__" and '--async' in sys.argv[1:]
+if cooperative:
+    try:
+        from gevent import monkey
+    except ImportError:
+        sys.exit("Install gevent to serve requests with --async")
+    monkey.patch_all()
+
+import collections
+import contextlib
+import cPickle as pickle
+import email.utils
+import heapq
+import itertools
 import json
 import logging
+import mmap
 import os
+import random
 import requests
+from requests.packages.urllib3.exceptions import NewConnectionError
 from requests_toolbelt import MultipartEncoder
+import signal
 import socket
-import sys
+from SocketServer import ThreadingMixIn
+import sqlite3
+import tempfile
 import time
 from twilio import TwilioRestException
+import urlparse
+import uuid
 from twilio.rest import TwilioRestClient
 import twilio.twiml
 import yaml
-import copy
 import base64
+import hashlib
 import hmac
+from multiprocessing.pool import ThreadPool
+import Queue
+import threading
+from wsgiref.simple_server import WSGIServer
 
 #
 # web services
 #
 
-from bottle import Bottle, route, run, request, abort, response, static_file, template
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from bottle import Bottle, route, run, request, abort, response, static_file, template, WSGIRefServer
 web = Bottle()
 
 @web.route("/ping", method=['GET', 'POST'])
@@ -45,6 +92,40 @@ def web_index(token=None):
 
     logging.info('Serving index page')
 
+    return serve_index(token, 'html')
+
+@web.route("/index.json", method=['GET', 'POST'])
+@web.route("/index.json/<token>", method=['GET', 'POST'])
+def web_index_json(token=None):
+    """
+    provides an index of buttons, in JSON
+
+    This function is called from monitoring tools, and it is protected
+    by the same token than the index page
+    """
+
+    logging.info('Serving index in JSON')
+
+    return serve_index(token, 'json')
+
+def serve_index(token, kind):
+    """
+    Serves the index of buttons
+
+    :param token: the security token of the index, if any
+    :type token: ``str``
+
+    :param kind: `html` or `json`
+    :type kind: ``str``
+
+    The index is rendered once for each version of the collection of
+    buttons. Clients that have the current version get `304 Not Modified`.
+
+    HTTP dates are rounded to the second, so `Last-Modified` is given only
+    once the second of the last change is over. The ETag is used to detect
+    changes made within the same second.
+    """
+
     try:
         if 'key' not in settings['server']:
             pass
@@ -61,9 +142,60 @@ def web_index(token=None):
             response.status = 400
             return 'Invalid request'
 
+    page = get_index_page(kind)
+
+    response.set_header('ETag', page['etag'])
+    if page['modified'] < int(time.time()):  # other changes may follow within this second
+        response.set_header('Last-Modified', email.utils.formatdate(page['modified'], usegmt=True))
+    response.set_header('Cache-Control', 'private, no-cache')
+
+    if is_fresh(page):
+        response.status = 304
+        return ''
+
+    response.content_type = page['type']
+    return page['body']
+
+# the index is rendered again when buttons or their tokens are changed
+#
+index_pages = {}
+index_version = 0
+index_modified = int(time.time())
+index_lock = threading.Lock()
+
+def touch_index():
+    """
+    Signals that the index of buttons has to be rendered again
+    """
+
+    global index_version, index_modified
+
+    with index_lock:
+        index_version += 1
+        index_modified = int(time.time())  # seconds in HTTP dates
+
+def get_index_page(kind):
+    """
+    Provides the index of buttons
+
+    :param kind: `html` or `json`
+    :type kind: ``str``
+
+    :return: the body, content type, ETag and time of last change
+    :rtype: ``dict``
+
+    """
+
+    with index_lock:
+        version = index_version
+        modified = index_modified
+        page = index_pages.get(kind)
+
+    if page is not None and page['version'] == version:
+        return page
+
     items = []
-    global buttons
-    for button in buttons:
+    for button in sorted(buttons.keys()):
         items.append({
             'label': button,
             'delete-url': '/delete/'+settings['tokens'].get(button+'-delete'),
@@ -72,7 +204,49 @@ def web_index(token=None):
             })
     logging.debug('Buttons: {}'.format(items))
 
-    return template('views/list_items', prefix=settings['server']['url'], items=items)
+    if kind == 'json':
+        body = json.dumps({'buttons': items})
+        content_type = 'application/json'
+    else:
+        body = template('views/list_items', prefix=settings['server']['url'], items=items)
+        content_type = 'text/html; charset=UTF-8'
+
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+
+    page = {'version': version,
+            'body': body,
+            'type': content_type,
+            'etag': '"{}"'.format(hashlib.sha1(body).hexdigest()[:20]),
+            'modified': modified}
+
+    with index_lock:
+        if index_version == version:
+            index_pages[kind] = page
+
+    return page
+
+def is_fresh(page):
+    """
+    Tells if the client has the current version of a page
+
+    :param page: the page as provided by ``get_index_page()``
+    :type page: ``dict``
+
+    :rtype: ``bool``
+
+    """
+
+    tags = request.headers.get('If-None-Match')
+    if tags is not None:
+        return page['etag'] in [tag.strip() for tag in tags.split(',')] or tags.strip() == '*'
+
+    since = request.headers.get('If-Modified-Since')
+    if since is not None and page['modified'] < int(time.time()):
+        date = email.utils.parsedate_tz(since)
+        return date is not None and email.utils.mktime_tz(date) >= page['modified']
+
+    return False
 
 #
 # invoked from bt.tn
@@ -96,8 +270,16 @@ def web_press(button=None):
 
         context = load_button(settings, button)
 
+        if settings['server'].get('queue_workers'):
+            return queue_push(context)
+
         return handle_button(context)
 
+    except Queue.Full:
+        logging.error("Too many pushes are waiting for execution")
+        response.status = 503
+        return 'Service unavailable'
+
     except socket.error as feedback:
         if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
             logging.error("Unable to push '{}'".format(button))
@@ -123,15 +305,26 @@ def handle_button(context):
     :param context: button state and configuration
     :type context: ``dict``
 
+    The push is cancelled if the room cannot be found, so that bt.tn can try
+    again with the same step.
     """
 
     logging.info("Handling button '{}'".format(context['name']))
 
-    context['spark']['id'] = get_room(context)
+    count = count_push(context)
+    if count is None:
+        return "OK {}\n".format(context['count'])
+
+    try:
+        context['spark']['id'] = get_room(context)
+
+    except Exception:
+        cancel_push(context, count)
+        raise
 
-    process_push(context)
+    execute_push(context, count)
 
-    return "OK {}\n".format(context['count'])
+    return "OK {}\n".format(count)
 
 def process_push(context):
     """
@@ -140,6 +333,9 @@ def process_push(context):
     :param context: button state and configuration
     :type context: ``dict``
 
+    :return: the rank of this push in the escalation, or None
+    :rtype: ``int``
+
     This function monitors the number of button pushes, and uses the appropriate
     action as defined in the configuration file, under the `bt.tn:` keyword.
 
@@ -155,37 +351,130 @@ def process_push(context):
 
     logging.info("Processing push")
 
-    context['count'] += 1
+    count = count_push(context)
+    if count is None:
+        return None
 
-    if 'time' in context:
-        elapsed = time.time() - context['time']
-    else:
-        elapsed = 0
+    execute_push(context, count)
+
+    return count
+
+def count_push(context):
+    """
+    Counts one push of the button
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :return: the rank of this push in the escalation, or None
+    :rtype: ``int``
+
+    The counter is reset if the button has not been pushed for the number of
+    minutes set with `reset:` in the `spark:` section of the configuration.
+
+    Pushes received within the number of seconds set with `debounce:` after
+    a counted push are coalesced with it, and None is returned.
+    """
 
     if 'reset' in context['spark']:
         reset = int(context['spark']['reset']) * 60
-        if elapsed > reset:
-            context['count'] = 1
+    else:
+        reset = None
+
+    if 'debounce' in context['spark']:
+        debounce = float(context['spark']['debounce'])
+    else:
+        debounce = None
 
-    update, phone = get_push_details(context)
+    count = get_state(context).push(context, reset, debounce=debounce)
 
-    if 'sms' in phone:
-        send_sms(context, phone['sms'])
+    with presses_lock:
+        if count is None:
+            logging.info("- coalesced with previous push")
+            presses['coalesced'] += 1
+            presses['buttons'][context['name']] = presses['buttons'].get(context['name'], 0) + 1
+        else:
+            presses['counted'] += 1
 
-    if 'call' in phone:
-        phone_call(context, phone['call'])
+    return count
 
-    post_update(context, update)
+def cancel_push(context, count):
+    """
+    Cancels a push that has not been handled
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :param count: the rank of the push, as provided by ``count_push()``
+    :type count: ``int``
+
+    The previous count and time of the button are restored, so that bt.tn can
+    try again with the same step. Nothing is changed if the button has been
+    pushed again in the meantime.
+    """
+
+    if not get_state(context).cancel(context, count):
+        return
+
+    logging.info("- push has been cancelled")
+    with presses_lock:
+        presses['counted'] -= 1
+
+# pushes of buttons since the server has been started
+#
+presses = {'counted': 0, 'coalesced': 0, 'buttons': {}}
+presses_lock = threading.Lock()
+
+def get_push_stats():
+    """
+    Reports on pushes that have been counted or coalesced
 
-    context['time'] = time.time()
+    :return: number of pushes, and of coalesced pushes for each button
+    :rtype: ``dict``
+
+    """
+
+    with presses_lock:
+        return {'counted': presses['counted'],
+                'coalesced': presses['coalesced'],
+                'coalesced_buttons': dict(presses['buttons'])}
+
+def execute_push(context, count):
+    """
+    Executes actions related to one push of the button
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :param count: the rank of the push in the escalation
+    :type count: ``int``
+
+    The content of the step and reports on SMS and calls are posted to the
+    room as a single message. Files are uploaded separately.
+    """
+
+    update, phone = get_push_details(context, count)
+
+    with batch_updates(context):
+
+        post_update(context, update)
 
-def get_push_details(context):
+        if 'sms' in phone:
+            send_sms(context, phone['sms'])
+
+        if 'call' in phone:
+            phone_call(context, phone['call'])
+
+def get_push_details(context, count=None):
     """
     Provides actions for current push
 
     :param context: button state and configuration
     :type context: ``dict``
 
+    :param count: the rank of the push, else the current counter is used
+    :type count: ``int``
+
     The action can be either:
 
     * send a text message to the room with `text:` statement
@@ -198,644 +487,3033 @@ def get_push_details(context):
 
     logging.info("Getting push details")
 
+    if count is None:
+        count = context['count']
+
     update = {'text': ''}
     phone = {}
 
-    items = context['bt.tn']
-    if context['count'] < len(items)+1:
-        logging.info("- using item {}".format(context['count']))
-        item = items[ context['count']-1 ]
+    plan = context['plan']
+    if count < len(plan)+1:
+        logging.info("- using item {}".format(count))
+        step = plan[ count-1 ]
 
         # textual message
         #
-        if 'markdown' in item:
-            update['markdown'] = item['markdown']
+        if step.markdown is not None:
+            update['markdown'] = step.markdown
 
-        elif 'message' in item:
-            update['text'] += item['message']+'\n'
+        elif step.message is not None:
+            update['text'] += step.message+'\n'
 
         # file upload
         #
-        if 'file' in item:
+        if step.file is not None:
 
-            logging.info("- attaching file '{}'".format(item['file']))
+            logging.info("- attaching file '{}'".format(step.file))
 
-            if 'label' in item:
-                text = item['label']
-                update['text'] += "'{}'".format(item['label'])+'\n'
+            if step.label is not None:
+                text = step.label
+                update['text'] += "'{}'".format(step.label)+'\n'
 
             else:
-                text = item['file']
+                text = step.file
 
-            if 'type' in item:
-                type = item['type']
-            else:
-                type = 'application/octet-stream'
+            upload = (text, get_attachment(context, step.file).open(), step.type)
 
-            update['files'] = (text, open(os.path.abspath(os.path.dirname(__file__))+'/'+item['file'], 'rb'), type)
+            url = get_hosted_url(context, step.file)
+            if url is not None:
+                logging.info("- using hosted copy at '{}'".format(url))
+                update['files'] = HostedFile(url, upload)
+
+            else:
+                update['files'] = upload
 
         # send a SMS
         #
-        if 'sms' in item:
-            phone = { 'sms': item['sms'] }
+        if step.sms is not None:
+            phone = { 'sms': step.sms }
 
         # phone call
         #
-        if 'call' in item:
-            phone = { 'call': item['call'] }
+        if step.call is not None:
+            phone = { 'call': step.call }
 
     # ping message
     #
     else:
-        update['text'] = 'push {}'.format(context['count'])
+        update['text'] = 'push {}'.format(count)
 
     return update, phone
 
 #
-# Handle Cisco Spark API
+# files attached to updates
 #
 
-def get_room(context):
+class Attachment(object):
     """
-    Looks for a suitable Cisco Spark room
-
-    :param context: button state and configuration
-    :type context: ``dict``
+    Provides the content of a file, mapped in memory
 
-    :return: the id of the target room
-    :rtype: ``str``
+    :param path: the full path of the file
+    :type path: ``str``
 
-    This function creates a new room if necessary
+    The file is mapped once, and its descriptor is closed right away.
+    Each upload gets its own stream on top of the same memory.
     """
 
-    logging.info("Looking for Cisco Spark room '{}'".format(context['spark']['room']))
+    def __init__(self, path):
+        self.path = path
 
-    url = 'https://api.ciscospark.com/v1/rooms'
-    headers = {'Authorization': 'Bearer '+context['spark']['CISCO_SPARK_BTTN_BOT']}
-    response = requests.get(url=url, headers=headers)
+        with open(path, 'rb') as handle:
+            stat = os.fstat(handle.fileno())
+            self.mtime = stat.st_mtime
+            self.size = stat.st_size
 
-    if response.status_code != 200:
-        logging.info(response.json())
-        raise Exception("Received error code {}".format(response.status_code))
+            if self.size > 0:
+                self.content = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.content = b''
 
-    for item in response.json()['items']:
-        if context['spark']['room'] in item['title']:
-            logging.info("- found it")
-            context['spark']['id'] = item['id']
-            return item['id']
+        self.digest = None
 
-    logging.info("- not found")
+    def is_fresh(self, stat):
+        return stat.st_mtime == self.mtime and stat.st_size == self.size
 
-    return create_room(context)
+    def get_digest(self):
+        """
+        Provides a hash of the content, computed only once
+        """
 
-def create_room(context):
-    """
-    Creates a new Cisco Spark room
+        if self.digest is None:
+            digest = hashlib.sha1()
+            for offset in range(0, self.size, 1024*1024):
+                digest.update(self.content[offset:offset+1024*1024])
+            self.digest = digest.hexdigest()
 
-    :param context: button state and configuration
-    :type context: ``dict``
+        return self.digest
 
-    :return: the id of the target room
-    :rtype: ``str``
+    def open(self):
+        return AttachmentStream(self.content)
 
-    This function also adds appropriate audience to the room
+class AttachmentStream(object):
     """
+    Reads the content of an attachment without copying it as a whole
 
-    logging.info("Creating Cisco Spark room '{}'".format(context['spark']['room']))
+    This is a minimal file-like object, that is accepted by MultipartEncoder.
+    The length of the stream is the number of bytes that remain to be read.
+    """
 
-    url = 'https://api.ciscospark.com/v1/rooms'
-    headers = {'Authorization': 'Bearer '+context['spark']['CISCO_SPARK_BTTN_BOT']}
-    payload = {'title': context['spark']['room'] }
-    response = requests.post(url=url, headers=headers, data=payload)
+    def __init__(self, content):
+        try:
+            self.view = memoryview(content)
+        except TypeError:  # mmap does not expose new-style buffers in Python 2
+            self.view = content
 
-    if response.status_code != 200:
-        logging.info(response.json())
-        raise Exception("Received error code {}".format(response.status_code))
+        self.size = len(content)
+        self.offset = 0
 
-    logging.info("- done")
-    room_id = response.json()['id']
-    context['spark']['id'] = get_room(context)
+    def __len__(self):
+        return self.size - self.offset
 
-    add_audience(context)
+    def seek(self, offset):
+        self.offset = offset
 
-    return room_id
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(self.offset + size, self.size)
 
-@web.route("/initialise", method=['GET', 'POST'])
-@web.route("/initialise/<button>", method=['GET', 'POST'])
-def web_initialise(button=None):
+        chunk = self.view[self.offset:end]
+        self.offset = end
+
+        if isinstance(chunk, memoryview):
+            return chunk.tobytes()
+        return chunk
+
+class AttachmentStore(object):
     """
-    Initialises a room
+    Keeps attachments in memory across pushes
 
-    This function is called from far far away, over the Internet
+    :param capacity: the maximum number of bytes to keep
+    :type capacity: ``int``
+
+    Least recently used attachments are dropped when the capacity is exceeded.
+    A file is mapped again if its modification time or size has changed.
     """
 
-    if button is None:
-        button = settings['server']['default']
+    def __init__(self, capacity=64*1024*1024):
+        self.capacity = capacity
+        self.attachments = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
 
-    logging.info("Initialising button '{}'".format(button))
+    def get(self, path):
+        stat = os.stat(path)
 
-    try:
-        button = decode_token(settings, button, action='initialise')
+        with self.lock:
+            attachment = self.attachments.pop(path, None)
+            if attachment is not None:
+                self.size -= attachment.size
 
-        context = load_button(settings, button)
-        delete_room(context)
+                if not attachment.is_fresh(stat):
+                    logging.debug("Reloading '{}'".format(path))
+                    attachment = None
 
-        global buttons
-        buttons.pop(button, None)
+            if attachment is None:
+                attachment = Attachment(path)
 
-        context = load_button(settings, button)
-        context['spark']['id'] = get_room(context)
+            self.attachments[path] = attachment
+            self.size += attachment.size
 
-        return 'OK'
+            while self.size > self.capacity and len(self.attachments) > 1:
+                unused, evicted = self.attachments.popitem(last=False)
+                logging.debug("Dropping '{}' from memory".format(evicted.path))
+                self.size -= evicted.size
 
-    except Exception as feedback:
-        if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
-            logging.error("Unable to initialise '{}'".format(button))
-            raise
-        else:
-            logging.error(str(feedback))
-            response.status = 400
-            return 'Invalid request'
+        return attachment
 
-@web.route("/delete", method=['GET', 'POST'])
-@web.route("/delete/<button>", method=['GET', 'POST'])
-def web_delete(button=None):
-    """
-    Deletes a room
+attachments = AttachmentStore()
 
-    This function is called from far far away, over the Internet
+def get_attachment(context, name):
     """
+    Provides a file attached to some step of a button
 
-    if button is None:
-        button = settings['server']['default']
+    :param context: button state and configuration
+    :type context: ``dict``
 
-    logging.info("Deleting button '{}'".format(button))
+    :param name: the file name, relative to the directory of the server
+    :type name: ``str``
 
-    try:
-        button = decode_token(settings, button, action='delete')
+    :return: the file content, mapped in memory
+    :rtype: ``Attachment``
 
-        context = load_button(settings, button)
-        delete_room(context)
+    The memory used by attachments is limited by `attachments_cache:`,
+    in megabytes, in the `server:` section of the configuration.
+    """
 
-        global buttons
-        buttons.pop(button, None)
+    attachments.capacity = int(context['server'].get('attachments_cache', 64))*1024*1024
 
-        return 'OK'
+    return attachments.get(os.path.abspath(os.path.dirname(__file__))+'/'+name)
 
-    except Exception as feedback:
-        if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
-            logging.error("Unable to delete '{}'".format(button))
-            raise
-        else:
-            logging.error(str(feedback))
-            response.status = 400
-            return 'Invalid request'
+hosted_files = {}
+hosted_lock = threading.Lock()
 
-def delete_room(context):
+def get_hosted_url(context, name):
     """
-    Deletes the target Cisco Spark room
+    Provides a public link to a file served by this server, if possible
 
     :param context: button state and configuration
     :type context: ``dict``
 
-    This function is useful to restart a clean demo environment
-    """
+    :param name: the file name, relative to the directory of the server
+    :type name: ``str``
 
-    logging.info("Deleting Cisco Spark room '{}'".format(context['spark']['room']))
+    :return: the url to pass to Cisco Spark, or None
+    :rtype: ``str``
 
-    url = 'https://api.ciscospark.com/v1/rooms'
-    headers = {'Authorization': 'Bearer '+context['spark']['CISCO_SPARK_BTTN_BOT']}
-    response = requests.get(url=url, headers=headers)
+    Files from the directory `files` are served at `/files/` by this server,
+    so that Cisco Spark can fetch them instead of receiving a full upload on
+    each push. Links are remembered by content hash, and files with the same
+    content share a single link. The hash is part of the link, so that a
+    changed file gets a new link.
 
-    if response.status_code != 200:
-        logging.info(response.json())
-        raise Exception("Received error code {}".format(response.status_code))
+    This is possible only if the server has a public url, and it can be
+    disabled with `hosted_files: false` in the `server:` section. A link that
+    has been rejected by Cisco Spark is not used anymore.
+    """
 
-    actual = False
-    for item in response.json()['items']:
+    if not context['server'].get('url'):
+        return None
 
-        if context['spark']['room'] in item['title']:
-            logging.info("- DELETING IT")
+    if not context['server'].get('hosted_files', True):
+        return None
 
-            url = 'https://api.ciscospark.com/v1/rooms/{}'.format(item['id'])
-            headers = {'Authorization': 'Bearer '+context['spark']['CISCO_SPARK_BTTN_BOT']}
-            response = requests.delete(url=url, headers=headers)
+    if not name.startswith('files/'):
+        return None
 
-            if response.status_code != 204:
-                raise Exception("Received error code {}".format(response.status_code))
+    digest = get_attachment(context, name).get_digest()
 
-            actual = True
+    with hosted_lock:
+        if digest not in hosted_files:
+            hosted_files[digest] = '{}/{}?{}'.format(context['server']['url'].rstrip('/'), name, digest[:16])
 
-    if actual:
-        logging.info("- room will be re-created in Cisco Spark on next button depress")
-    else:
-        logging.info("- no room with this name yet - it will be created on next button depress")
+        return hosted_files[digest]
 
-def add_audience(context):
+def drop_hosted_url(url):
     """
-    Gives a chance to some listeners to catch updates
+    Stops using a link to a file served by this server
 
-    :param context: button state and configuration
-    :type context: ``dict``
+    :param url: the link that Cisco Spark has been unable to fetch
+    :type url: ``str``
 
-    This function adds pre-defined listeners to a Cisco Spark room
     """
 
-    logging.info("Adding moderators to the Cisco Spark room")
+    with hosted_lock:
+        for digest, link in hosted_files.items():
+            if link == url:
+                hosted_files[digest] = None
 
-    for item in context['spark'].get('moderators', ()):
-        logging.info("- {}".format(item))
-        add_person(context, person=item, isModerator='true')
+class HostedFile(str):
+    """
+    Provides the link to a file served by this server
 
-    logging.info("Adding participants to the Cisco Spark room")
+    :param url: the link passed to Cisco Spark
+    :type url: ``str``
 
-    for item in context['spark'].get('participants', ()):
-        logging.info("- {}".format(item))
-        add_person(context, person=item)
+    :param upload: the label, stream and type of the file, if it has to be
+        uploaded instead
+    :type upload: ``tuple``
 
-def add_person(context, person=None, isModerator='false'):
+    The link is sent as a plain string in form data.
     """
-    Adds a person to a room
 
-    :param context: button state and configuration
-    :type context: ``dict``
+    def __new__(cls, url, upload):
+        link = str.__new__(cls, url)
+        link.upload = upload
+        return link
 
-    :param person: e-mail address of the person to add
-    :type person: ``str``
+#
+# asynchronous processing of pushes
+#
 
-    :param isModerator: for moderators
-    :type isModerator: `true` or `false`
+jobs = None
+slots = None  # places in the queue, taken before pushes are counted
+pipeline = {'workers': [],
+            'processed': 0,
+            'failed': 0,
+            'latency': 0.0,
+            'max_latency': 0.0}
+pipeline_lock = threading.Lock()
 
+def start_pipeline(settings):
     """
+    Starts workers that execute queued pushes
 
-    url = 'https://api.ciscospark.com/v1/memberships'
-    headers = {'Authorization': 'Bearer '+context['spark']['CISCO_SPARK_BTTN_BOT']}
-    payload = {'roomId': context['spark']['id'],
-               'personEmail': person,
-               'isModerator': isModerator }
-    response = requests.post(url=url, headers=headers, data=payload)
+    :param settings: generic settings, or button state and configuration
+    :type settings: ``dict``
 
-    if response.status_code != 200:
-        logging.info(response.json())
-        raise Exception("Received error code {}".format(response.status_code))
+    The number of workers is set with `queue_workers:` in the `server:`
+    section of the configuration, and the number of pushes waiting for
+    a worker is limited with `queue_size:`.
+    """
 
-def post_update(context, update):
+    global jobs, slots
+
+    with pipeline_lock:
+        if jobs is not None:
+            return
+
+        size = int(settings['server'].get('queue_size', 1000))
+        slots = threading.Semaphore(size)
+        jobs = Queue.Queue(maxsize=size)
+
+        for index in range(int(settings['server'].get('queue_workers', 4))):
+            worker = threading.Thread(target=work_pipeline,
+                                      name='push-{}'.format(index))
+            worker.daemon = True
+            worker.start()
+            pipeline['workers'].append(worker)
+
+    logging.info("Started {} workers for pushes".format(len(pipeline['workers'])))
+
+def queue_push(context):
     """
-    Updates a Cisco Spark room
+    Counts one push of the button, and queues related actions
 
     :param context: button state and configuration
     :type context: ``dict``
 
-    :param update: content of the update to be posted there
-    :type update: ``str`` or ``dict``
+    :return: the response to bt.tn
+    :rtype: ``str``
 
-    If the update is a simple string, it is sent as such to Cisco Spark.
-    Else if it a dictionary, then it is encoded as MIME Multipart.
+    This function returns as soon as the push has been counted, and actions
+    are executed later on by a worker.
+
+    A place is taken in the queue before the push is counted, so that a push
+    rejected with ``Queue.Full`` is not counted, and bt.tn can try again
+    with the same step. The push is cancelled if it cannot be queued.
     """
 
-    logging.info("Posting update to Cisco Spark room")
+    logging.info("Queuing button '{}'".format(context['name']))
 
-    url = 'https://api.ciscospark.com/v1/messages'
-    headers = {'Authorization': 'Bearer '+context['spark']['CISCO_SPARK_BTTN_BOT']}
+    if jobs is None:
+        start_pipeline(context)
 
-    if isinstance(update, dict):
-        update['roomId'] = context['spark']['id']
-        payload = MultipartEncoder(fields=update)
-        headers['Content-Type'] = payload.content_type
-    else:
-        payload = {'roomId': context['spark']['id'], 'text': update }
+    if not slots.acquire(False):
+        raise Queue.Full
 
-    response = requests.post(url=url, headers=headers, data=payload)
+    count = None
+    try:
+        count = count_push(context)
+        if count is None:
+            slots.release()
+            return "OK {}\n".format(context['count'])
 
-    if response.status_code != 200:
-        logging.info(response.json())
-        raise Exception("Received error code {}".format(response.status_code))
+        jobs.put_nowait((context, count, time.time()))
 
-    logging.info('- done, check the room with Cisco Spark client software')
+    except Exception:
+        slots.release()
+        if count is not None:
+            cancel_push(context, count)
+        raise
+
+    return "OK {}\n".format(count)
+
+def work_pipeline():
+    """
+    Executes queued pushes, one at a time
+    """
+
+    while True:
+        context, count, queued = jobs.get()
+        slots.release()
+
+        try:
+            logging.info("Handling button '{}'".format(context['name']))
+
+            context['spark']['id'] = get_room(context)
+
+            execute_push(context, count)
+
+            failed = 0
+
+        except Exception as feedback:
+            logging.error("Unable to push '{}'".format(context['name']))
+            logging.exception(feedback)
+
+            failed = 1
+
+        latency = time.time() - queued
+
+        with pipeline_lock:
+            pipeline['processed'] += 1
+            pipeline['failed'] += failed
+            pipeline['latency'] = latency
+            pipeline['max_latency'] = max(latency, pipeline['max_latency'])
+
+        jobs.task_done()
+
+def get_pipeline_stats():
+    """
+    Reports on the processing of queued pushes
+
+    :return: queue depth, number of jobs, and latency in seconds
+    :rtype: ``dict``
+
+    """
+
+    with pipeline_lock:
+        return {'workers': len(pipeline['workers']),
+                'depth': jobs.qsize() if jobs is not None else 0,
+                'processed': pipeline['processed'],
+                'failed': pipeline['failed'],
+                'latency': pipeline['latency'],
+                'max_latency': pipeline['max_latency']}
+
+@web.route("/stats", method=['GET', 'POST'])
+@web.route("/stats/<token>", method=['GET', 'POST'])
+def web_stats(token=None):
+    """
+    Reports on the processing of pushes
+
+    This function is called from monitoring tools, and it is protected
+    by the same token than the index page
+    """
+
+    try:
+        if 'key' not in settings['server']:
+            pass
+
+        elif decode_token(settings, token) != 'index':
+            raise ValueError('Invalid label in token')
+
+    except Exception as feedback:
+        if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
+            logging.error("Unable to serve statistics")
+            raise
+        else:
+            logging.error(str(feedback))
+            response.status = 400
+            return 'Invalid request'
+
+    response.content_type = 'application/json'
+    return json.dumps(dict(get_pipeline_stats(), pushes=get_push_stats()))
 
 #
-# handle Twilio API
+# retry transient failures of remote services
 #
 
-def send_sms(context, details):
-    """"
-    Sends a SMS to target people
+class CircuitOpenError(requests.ConnectionError):
+    """
+    Raised when calls to a remote service are suspended
+    """
 
-    :param context: button state and configuration
-    :type context: ``dict``
+class CircuitBreaker(object):
+    """
+    Suspends calls to a remote service after consecutive failures
 
-    :param details: what to send and to which numbers
-    :type details: ``list``
+    :param failures: number of consecutive failures that open the circuit
+    :type failures: ``int``
 
-    This function uses the Twilio API to send a SMS message to target people
+    :param cooldown: seconds before a new call is attempted
+    :type cooldown: ``float``
+
+    When the circuit is open, calls fail immediately. After the cooldown,
+    one call at a time is let through, and the circuit is closed again on
+    first success.
     """
-    logging.info("- sending a SMS")
 
-    handle = TwilioRestClient(context['twilio']['TWILIO_ACCOUNT_SID'],
-                              context['twilio']['TWILIO_AUTH_TOKEN'])
+    def __init__(self, failures=5, cooldown=30):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.count = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+
+            if time.time() - self.opened < self.cooldown:
+                return False
+
+            self.opened = time.time()  # one trial call during next cooldown
+            return True
+
+    def succeed(self):
+        with self.lock:
+            self.count = 0
+            self.opened = None
+
+    def fail(self):
+        with self.lock:
+            self.count += 1
+            if self.count >= self.failures:
+                if self.opened is None:
+                    logging.warning("- suspending calls after {} failures".format(self.count))
+                self.opened = time.time()
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+def get_breaker(settings, endpoint):
+    """
+    Provides the circuit breaker of a remote endpoint
 
-    message = ''
-    from_number = context['twilio']['customer_service_number']
-    to_numbers = []
+    :param settings: the `spark:` or `twilio:` section of the configuration
+    :type settings: ``dict``
 
-    for line in details:
-        if not isinstance(line, dict):
-            logging.error("Invalid statement: '{}'".format(str(line)))
-            update = { 'markdown': 'Error: Unable to send a SMS - check configuration'}
-            post_update(context, update)
-            return
+    :param endpoint: the name of the endpoint
+    :type endpoint: ``str``
 
-        if line.keys()[0] == 'message':
-            message = line['message']
+    :return: the breaker shared by all calls to this endpoint
+    :rtype: ``CircuitBreaker``
 
-        if line.keys()[0] == 'from':
-            from_number = line['from']
+    """
 
-        if line.keys()[0] == 'number':
-            to_numbers.append(line['number'])
+    with breakers_lock:
+        breaker = breakers.get(endpoint)
+        if breaker is None:
+            breaker = breakers[endpoint] = CircuitBreaker()
 
-    if len(message) < 4:
-        logging.error("Message should have at least 4 characters: '{}'".format(str(message)))
-        update = { 'markdown': 'Error: No SMS message to send - check configuration'}
-        post_update(context, update)
-        return
+    breaker.failures = int(settings.get('circuit_failures', 5))
+    breaker.cooldown = float(settings.get('circuit_cooldown', 30))
+    return breaker
 
-    logging.info("- sending '{}'".format(message))
+def call_resilient(settings, endpoint, action, transient):
+    """
+    Calls a remote service, and retries on transient failures
 
-    if len(to_numbers) < 1:
-        logging.error("No phone number has been defined")
-        update = { 'markdown': 'Error: No target phone number for SMS - check configuration'}
-        post_update(context, update)
-        return
+    :param settings: the `spark:` or `twilio:` section of the configuration
+    :type settings: ``dict``
 
-    if from_number is None:
-        from_number = to_numbers[0]
+    :param endpoint: the name of the endpoint, for its circuit breaker
+    :type endpoint: ``str``
 
-    for number in to_numbers:
-        logging.info("- sending to '{}'".format(number))
+    :param action: makes one call and returns its outcome
+    :type action: ``callable``
+
+    :param transient: tells if the outcome or the exception of a call is
+        transient, with the minimum number of seconds to wait, or None
+    :type transient: ``callable``
+
+    :return: the outcome of the last call
+
+    Calls are retried after an exponential backoff with full jitter, that
+    starts at `retry_delay:` seconds, until `retry_deadline:` seconds have
+    elapsed. The last outcome is returned, or the last exception is raised.
+
+    A ``CircuitOpenError`` is raised without any call if the endpoint has
+    failed `circuit_failures:` times in a row, for `circuit_cooldown:`
+    seconds.
+    """
+
+    breaker = get_breaker(settings, endpoint)
+    if not breaker.allow():
+        raise CircuitOpenError("Calls to '{}' have been suspended".format(endpoint))
 
+    deadline = time.time() + float(settings.get('retry_deadline', 10))
+    delay = float(settings.get('retry_delay', 0.5))
+
+    attempt = 0
+    while True:
+        outcome = error = None
         try:
-            pass
-            handle.messages.create(body=message,
-                                   to=number,
-                                   from_=from_number)
+            outcome = action()
+        except Exception as feedback:
+            error = feedback
+
+        if is_failure(outcome, error):
+            breaker.fail()
+        elif error is None:
+            breaker.succeed()
+
+        wait = transient(outcome, error)
+        if wait is not None:
+            attempt += 1
+            pause = max(wait, random.uniform(0, delay * 2 ** attempt))
+            if time.time() + pause < deadline and breaker.allow():
+                logging.info("- retrying '{}' in {:.1f} seconds".format(endpoint, pause))
+                time.sleep(pause)
+                continue
+
+        if error is not None:
+            raise error
+        return outcome
+
+class RateLimitError(requests.RequestException):
+    """
+    Raised when too many calls are waiting for a rate limiter
 
-        except socket.error as feedback:
-            logging.error("Unable to communicate with Twilio API endpoint")
-            logging.error(str(feedback))
-            update = { 'markdown': 'Error: Unable to communicate with Twilio API endpoint'}
-            post_update(context, update)
-            return
+    This is a local condition, that is neither retried nor counted as a
+    failure of the remote service.
+    """
 
-        except TwilioRestException as feedback:
-            logging.error("Receive Exception from Twilio API")
-            logging.error(str(feedback))
-            update = { 'markdown': 'Error: Receive Exception from Twilio API'}
-            post_update(context, update)
-            return
+class RateLimiter(object):
+    """
+    Spreads calls to a remote service over time
 
-    update = { 'markdown': "SMS '{}' has been sent to '{}'".format(message,
-                                                   ', '.join(to_numbers))}
-    post_update(context, update)
+    :param rate: number of calls per second
+    :type rate: ``float``
 
-def phone_call(context, details):
-    """"
-    Calls people
+    :param burst: number of calls that can be made at once
+    :type burst: ``int``
+
+    :param queue: maximum number of calls waiting for their turn
+    :type queue: ``int``
+
+    This is a token bucket. Calls that have to wait are served by priority,
+    then in order of arrival.
+    """
+
+    def __init__(self, rate=10, burst=10, queue=100):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.queue = int(queue)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.key = None
+
+    def acquire(self, priority=1):
+        with self.condition:
+            if len(self.waiting) >= self.queue:
+                raise RateLimitError("Too many calls are waiting for their turn")
+
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    now = time.time()
+                    self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                    self.stamp = now
+
+                    if self.waiting[0] != ticket:
+                        self.condition.wait()
+
+                    elif self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+
+                    else:
+                        self.condition.wait((1 - self.tokens) / self.rate)
+
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+def get_limiter(settings, bearer):
+    """
+    Provides the rate limiter of a bot token
+
+    :param settings: the `spark:` section of the configuration
+    :type settings: ``dict``
+
+    :param bearer: the credentials used in calls
+    :type bearer: ``str``
+
+    :return: the limiter shared by all calls made with these credentials
+    :rtype: ``RateLimiter``
+
+    The limiter is built from `rate:`, `burst:` and `rate_queue:`, and is
+    re-built if these settings are changed.
+    """
+
+    key = (bearer, settings.get('rate'), settings.get('burst'), settings.get('rate_queue'))
+
+    with limiters_lock:
+        limiter = limiters.get(bearer)
+        if limiter is None or limiter.key != key:
+            limiter = RateLimiter(rate=settings['rate'],
+                                  burst=settings.get('burst', settings['rate']),
+                                  queue=settings.get('rate_queue', 100))
+            limiter.key = key
+            limiters[bearer] = limiter
+
+    return limiter
+
+def is_failure(outcome, error):
+    """
+    Tells if a remote service has failed to process a call
+
+    :param outcome: the response of the service, if any
+    :param error: the exception raised by the call, if any
+
+    :rtype: ``bool``
+
+    Exceptions, and responses 429 and 5xx, are failures, except for
+    exceptions raised locally without calling the service, e.g., when the
+    circuit is open or when too many calls wait for a rate limiter. Other responses,
+    including 4xx errors from Twilio, show that the service is working.
+    """
+
+    if error is not None:
+        if isinstance(error, (CircuitOpenError, RateLimitError)):
+            return False
+
+        if isinstance(error, TwilioRestException):
+            return error.status == 429 or error.status >= 500
+
+        return True
+
+    status = getattr(outcome, 'status_code', None)
+    return status is not None and (status == 429 or status >= 500)
+
+def get_retry_after(headers):
+    """
+    Reads the number of seconds to wait before a new request
+
+    :param headers: headers of the response
+    :type headers: ``dict``
+
+    :return: seconds from the header `Retry-After`, or 0
+    :rtype: ``float``
+
+    """
+
+    value = headers.get('Retry-After')
+    if not value:
+        return 0
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return 0
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+def check_spark(response, error):
+    """
+    Tells if a call to Cisco Spark can be retried
+
+    Connection errors and time-outs, responses 429 and 5xx are transient.
+    """
+
+    if error is not None:
+        if isinstance(error, CircuitOpenError):
+            return None
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return 0
+        return None
+
+    if response.status_code == 429 or response.status_code >= 500:
+        return get_retry_after(response.headers)
+
+    return None
+
+def check_spark_unprocessed(response, error):
+    """
+    Tells if a call to Cisco Spark can be retried without side-effect
+
+    Only failed connections, and responses 429 and 503, are transient.
+    """
+
+    if error is not None:
+        if isinstance(error, requests.ConnectTimeout):
+            return 0
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        if isinstance(reason, NewConnectionError):
+            return 0
+        return None
+
+    if response.status_code in (429, 503):
+        return get_retry_after(response.headers)
+
+    return None
+
+def check_twilio(outcome, error):
+    """
+    Tells if a call to Twilio can be retried without side-effect
+
+    Connection errors other than time-outs, and responses 429 and 503, are
+    transient. A time-out may happen after Twilio has processed the call.
+    """
+
+    if isinstance(error, TwilioRestException):
+        if error.status in (429, 503):
+            return 0
+        return None
+
+    if isinstance(error, socket.error) and not isinstance(error, socket.timeout):
+        return 0
+
+    return None
+
+#
+# Handle Cisco Spark API
+#
+
+class SparkClient(object):
+    """
+    Sends requests to the Cisco Spark API over pooled connections
+
+    :param settings: the ``spark:`` section of the configuration
+    :type settings: ``dict``
+
+    All calls to Cisco Spark go through a single ``requests.Session``, so that
+    TCP and TLS connections are kept alive and re-used across pushes. The pool
+    and timeouts are set in the ``spark:`` section of the configuration, with
+    ``pool_size:``, ``connect_timeout:`` and ``timeout:``.
+
+    Transient failures are retried with `call_resilient()`. Requests that
+    change something are retried only if Cisco Spark has not processed them.
+    Use a function as `data` to build a fresh body for each attempt.
+
+    If `rate:` is set, calls made with each bot token are spread over time
+    with a `RateLimiter`. Use `priority` to pass before other calls, from
+    0 for updates of rooms to 2 for bulk additions of people.
+    """
+
+    def __init__(self, settings={}):
+        self.key = SparkClient.get_key(settings)
+        self.settings = dict(settings)
+
+        self.pool_size = int(settings.get('pool_size', 10))
+        self.timeout = (float(settings.get('connect_timeout', 5)),
+                        float(settings.get('timeout', 30)))
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @staticmethod
+    def get_key(settings):
+        return (settings.get('pool_size'),
+                settings.get('connect_timeout'),
+                settings.get('timeout'),
+                settings.get('retry_deadline'),
+                settings.get('retry_delay'),
+                settings.get('circuit_failures'),
+                settings.get('circuit_cooldown'),
+                settings.get('rate'),
+                settings.get('burst'),
+                settings.get('rate_queue'))
+
+    def request(self, method, url, priority=1, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        build = kwargs.pop('data') if callable(kwargs.get('data')) else None
+
+        limiter = None
+        if self.settings.get('rate'):
+            bearer = (kwargs.get('headers') or {}).get('Authorization')
+            limiter = get_limiter(self.settings, bearer)
+
+        def attempt():
+            if limiter is not None:
+                limiter.acquire(priority)
+            if build is not None:
+                kwargs['data'] = build()
+            return self.session.request(method, url, **kwargs)
+
+        if method.upper() in ('GET', 'HEAD', 'PUT', 'DELETE'):
+            transient = check_spark
+        else:
+            transient = check_spark_unprocessed
+
+        parsed = urlparse.urlparse(url)
+        endpoint = parsed.netloc+'/'.join(parsed.path.split('/')[:3])
+
+        return call_resilient(self.settings, endpoint, attempt, transient)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+spark_client = None
+
+def get_spark(context):
+    """
+    Provides the shared client of the Cisco Spark API
 
     :param context: button state and configuration
     :type context: ``dict``
 
-    :param details: what to send and to which numbers
-    :type details: ``list``
+    :return: the client used for all Cisco Spark calls
+    :rtype: ``SparkClient``
 
-    This function uses the Twilio API to send a SMS message to target people
+    The client is built on first call, and re-built only if pool or timeout
+    settings have been changed.
     """
-    logging.info("- passing a phone call")
 
-    handle = TwilioRestClient(context['twilio']['TWILIO_ACCOUNT_SID'],
-                              context['twilio']['TWILIO_AUTH_TOKEN'])
+    global spark_client
 
-    url = ''
-    from_number = context['twilio']['customer_service_number']
-    to_numbers = []
-    say = ''
+    settings = context.get('spark') or {}
+    if spark_client is None or spark_client.key != SparkClient.get_key(settings):
+        spark_client = SparkClient(settings)
 
-    for line in details:
-        if not isinstance(line, dict):
-            logging.error("Invalid statement: '{}'".format(str(line)))
-            update = { 'markdown': 'Error: Unable to call - check configuration'}
-            post_update(context, update)
-            return
+    return spark_client
 
-        if line.keys()[0] == 'url':
-            url = line['url']
+def get_room(context):
+    """
+    Looks for a suitable Cisco Spark room
 
-        if line.keys()[0] == 'say':
-            context['twilio']['say'] = line['say']
+    :param context: button state and configuration
+    :type context: ``dict``
 
-        if line.keys()[0] == 'from':
-            from_number = line['from']
+    :return: the id of the target room
+    :rtype: ``str``
 
-        if line.keys()[0] == 'number':
-            to_numbers.append(line['number'])
+    The id of the room is remembered for each button, so that next pushes
+    only have to check that the room is still there. Rooms are listed
+    only if the room is unknown, or if it has disappeared in the meantime.
 
-    if len(url) < 4:
-        if context['server']['url'] is None:
-            logging.error("Missing url: configuration information")
-            update = { 'markdown': 'Error: No URL for the call - check configuration'}
-            post_update(context, update)
-            return
-        url = context['server']['url'].rstrip('/')+'/call/'+encode_token(context, context['name'], action='call')
+    This function creates a new room if necessary. Concurrent pushes of the
+    same button wait for the first one to find or to create the room.
+    """
 
-    logging.info("- using '{}'".format(url))
+    logging.info("Looking for Cisco Spark room '{}'".format(context['spark']['room']))
 
-    if len(to_numbers) < 1:
-        logging.error("No phone number has been defined")
-        update = { 'markdown': 'Error: No target phone number for call - check configuration'}
-        post_update(context, update)
-        return
+    headers = {'Authorization': 'Bearer '+context['spark']['CISCO_SPARK_BTTN_BOT']}
 
-    if from_number is None:
-        from_number = to_numbers[0]
+    room_id = get_cached_room(context['name'])
+    if room_id is not None:
 
-    for number in to_numbers:
-        logging.info("- calling '{}'".format(number))
+        url = 'https://api.ciscospark.com/v1/rooms/{}'.format(room_id)
+        response = get_spark(context).get(url=url, headers=headers)
 
-        try:
-            handle.calls.create(to=number,
-                                from_=from_number,
-                                url=url)
+        if response.status_code == 200:
+            if context['spark']['room'] in response.json()['title']:
+                logging.info("- found it in cache")
+                context['spark']['id'] = room_id
+                return room_id
 
-            update = { 'markdown': "Calling '{}'".format(number)}
-            post_update(context, update)
+            logging.info("- cached room has another title")
+            forget_room(context['name'], room_id)
 
-        except socket.error as feedback:
-            logging.error("Unable to communicate with Twilio API endpoint")
-            logging.error(str(feedback))
-            update = { 'markdown': 'Error: Unable to communicate with Twilio API endpoint'}
-            post_update(context, update)
-            return
+        elif response.status_code == 404:
+            logging.info("- cached room has disappeared")
+            forget_room(context['name'], room_id)
 
-        except TwilioRestException as feedback:
-            logging.error("Receive Exception from Twilio API")
-            logging.error(str(feedback))
-            update = { 'markdown': 'Error: Receive Exception from Twilio API'}
-            post_update(context, update)
-            return
+        else:
+            logging.info(response.json())
+            raise Exception("Received error code {}".format(response.status_code))
 
-@web.route("/call", method=['GET', 'POST'])
-@web.route("/call/<button>", method=['GET', 'POST'])
-def web_inbound_call(button=None):
+    with lock_room(context['name']), lock_rooms(context):
+
+        room_id = get_cached_room(context['name'])
+        if room_id is not None:
+            logging.info("- found it in cache")
+            context['spark']['id'] = room_id
+            return room_id
+
+        for item in list_rooms(context):
+            if context['spark']['room'] in item['title']:
+                logging.info("- found it")
+                context['spark']['id'] = item['id']
+                remember_room(context['name'], item['id'])
+                return item['id']
+
+        logging.info("- not found")
+
+        return create_room(context)
+
+def list_rooms(context):
     """
-    Handles an inbound phone call
+    Lists Cisco Spark rooms that the bot is a member of
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :return: a generator of room descriptions
+    :rtype: ``generator`` of ``dict``
+
+    Rooms are fetched one page at a time, following the ``Link: rel="next"``
+    header provided by Cisco Spark, and only when the previous page has been
+    consumed. Therefore callers can stop as soon as they have found what they
+    were looking for, and only one page is held in memory at any time.
+
+    The size of pages can be set with ``page_size:`` in the ``spark:``
+    section of the configuration.
+    """
+
+    url = 'https://api.ciscospark.com/v1/rooms'
+    headers = {'Authorization': 'Bearer '+context['spark']['CISCO_SPARK_BTTN_BOT']}
+    params = {'max': context['spark'].get('page_size', 100)}
+
+    while url:
+        response = get_spark(context).get(url=url, headers=headers, params=params)
+
+        if response.status_code != 200:
+            logging.info(response.json())
+            raise Exception("Received error code {}".format(response.status_code))
+
+        for item in response.json()['items']:
+            yield item
+
+        url = response.links.get('next', {}).get('url')
+        params = None  # already in the url of next page
+
+def create_room(context):
+    """
+    Creates a new Cisco Spark room
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :return: the id of the target room
+    :rtype: ``str``
+
+    This function also adds appropriate audience to the room
+    """
+
+    logging.info("Creating Cisco Spark room '{}'".format(context['spark']['room']))
+
+    url = 'https://api.ciscospark.com/v1/rooms'
+    headers = {'Authorization': 'Bearer '+context['spark']['CISCO_SPARK_BTTN_BOT']}
+    payload = {'title': context['spark']['room'] }
+    response = get_spark(context).post(url=url, headers=headers, data=payload)
+
+    if response.status_code != 200:
+        logging.info(response.json())
+        raise Exception("Received error code {}".format(response.status_code))
+
+    logging.info("- done")
+    room_id = response.json()['id']
+    context['spark']['id'] = room_id
+    remember_room(context['name'], room_id)
+
+    add_audience(context)
+
+    return room_id
+
+@web.route("/initialise", method=['GET', 'POST'])
+@web.route("/initialise/<button>", method=['GET', 'POST'])
+def web_initialise(button=None):
+    """
+    Initialises a room
+
+    This function is called from far far away, over the Internet
+    """
+
+    if button is None:
+        button = settings['server']['default']
+
+    logging.info("Initialising button '{}'".format(button))
+
+    try:
+        button = decode_token(settings, button, action='initialise')
+
+        context = load_button(settings, button)
+        delete_room(context)
+
+        global buttons
+        buttons.pop(button, None)
+
+        context = load_button(settings, button)
+        context['spark']['id'] = get_room(context)
+
+        return 'OK'
+
+    except Exception as feedback:
+        if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
+            logging.error("Unable to initialise '{}'".format(button))
+            raise
+        else:
+            logging.error(str(feedback))
+            response.status = 400
+            return 'Invalid request'
+
+@web.route("/delete", method=['GET', 'POST'])
+@web.route("/delete/<button>", method=['GET', 'POST'])
+def web_delete(button=None):
+    """
+    Deletes a room
+
+    This function is called from far far away, over the Internet
+    """
+
+    if button is None:
+        button = settings['server']['default']
+
+    logging.info("Deleting button '{}'".format(button))
+
+    try:
+        button = decode_token(settings, button, action='delete')
+
+        context = load_button(settings, button)
+        delete_room(context)
+
+        global buttons
+        buttons.pop(button, None)
+        touch_index()
+
+        return 'OK'
+
+    except Exception as feedback:
+        if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
+            logging.error("Unable to delete '{}'".format(button))
+            raise
+        else:
+            logging.error(str(feedback))
+            response.status = 400
+            return 'Invalid request'
+
+def delete_room(context):
+    """
+    Deletes the target Cisco Spark room
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    This function is useful to restart a clean demo environment
+    """
+
+    logging.info("Deleting Cisco Spark room '{}'".format(context['spark']['room']))
+
+    targets = [item['id'] for item in list_rooms(context)
+               if context['spark']['room'] in item['title']]
+
+    actual = False
+    for room_id in targets:
+        logging.info("- DELETING IT")
+
+        url = 'https://api.ciscospark.com/v1/rooms/{}'.format(room_id)
+        headers = {'Authorization': 'Bearer '+context['spark']['CISCO_SPARK_BTTN_BOT']}
+        response = get_spark(context).delete(url=url, headers=headers)
+
+        if response.status_code != 204:
+            raise Exception("Received error code {}".format(response.status_code))
+
+        actual = True
+
+    forget_room(context['name'])
+    get_state(context).clear(context)
+
+    if actual:
+        logging.info("- room will be re-created in Cisco Spark on next button depress")
+    else:
+        logging.info("- no room with this name yet - it will be created on next button depress")
+
+def add_audience(context):
+    """
+    Gives a chance to some listeners to catch updates
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    This function adds pre-defined listeners to a Cisco Spark room.
+
+    Memberships are created concurrently, with at most `workers:` requests
+    at a time as set in the `spark:` section of the configuration. Once all
+    people have been processed, a summary is posted to the room.
+    """
+
+    logging.info("Adding moderators and participants to the Cisco Spark room")
+
+    people = [(item, 'true') for item in context['spark'].get('moderators', ())]
+    people += [(item, 'false') for item in context['spark'].get('participants', ())]
+
+    def add(person):
+        email, isModerator = person
+        logging.info("- {}".format(email))
+
+        try:
+            return add_person(context, person=email, isModerator=isModerator)
+
+        except Exception as feedback:
+            logging.error("Unable to add '{}'".format(email))
+            logging.error(str(feedback))
+            return str(feedback)
+
+    outcomes = fan_out(add, people, context['spark'].get('workers', 8))
+
+    lines = []
+
+    added = [email for (email, unused), outcome in zip(people, outcomes) if outcome == 'added']
+    if added:
+        lines.append("Welcome to '{}'".format(', '.join(added)))
+
+    present = [email for (email, unused), outcome in zip(people, outcomes) if outcome == 'present']
+    if present:
+        lines.append("Already in the room: '{}'".format(', '.join(present)))
+
+    for (email, unused), outcome in zip(people, outcomes):
+        if outcome not in ('added', 'present'):
+            lines.append("Error: Unable to add '{}' - {}".format(email, outcome))
+
+    if lines:
+        post_update(context, { 'markdown': '\n\n'.join(lines) })
+
+def add_person(context, person=None, isModerator='false'):
+    """
+    Adds a person to a room
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :param person: e-mail address of the person to add
+    :type person: ``str``
+
+    :param isModerator: for moderators
+    :type isModerator: `true` or `false`
+
+    :return: `added`, or `present` if the person was already a member
+    :rtype: ``str``
+
+    """
+
+    url = 'https://api.ciscospark.com/v1/memberships'
+    headers = {'Authorization': 'Bearer '+context['spark']['CISCO_SPARK_BTTN_BOT']}
+    payload = {'roomId': context['spark']['id'],
+               'personEmail': person,
+               'isModerator': isModerator }
+    response = get_spark(context).post(url=url, headers=headers, data=payload, priority=2)
+
+    if response.status_code == 409:
+        logging.info("- already a member")
+        return 'present'
+
+    if response.status_code != 200:
+        logging.info(response.json())
+        raise Exception("Received error code {}".format(response.status_code))
+
+    return 'added'
+
+def post_update(context, update):
+    """
+    Updates a Cisco Spark room
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :param update: content of the update to be posted there
+    :type update: ``str`` or ``dict``
+
+    If the update is a simple string, it is sent as such to Cisco Spark.
+    Else if it a dictionary with a file to upload, then it is encoded as MIME
+    Multipart. Other dictionaries, including those that reference hosted files
+    by their url, are sent as regular form data. If Cisco Spark rejects the url
+    of a hosted file, then the file is uploaded instead.
+
+    Updates without files are kept for later if `batch_updates()` is active.
+    """
+
+    if keep_update(context, update):
+        return
+
+    logging.info("Posting update to Cisco Spark room")
+
+    url = 'https://api.ciscospark.com/v1/messages'
+    headers = {'Authorization': 'Bearer '+context['spark']['CISCO_SPARK_BTTN_BOT']}
+
+    if isinstance(update, dict) and isinstance(update.get('files'), tuple):
+        update['roomId'] = context['spark']['id']
+        boundary = uuid.uuid4().hex
+
+        def payload():  # a new encoder for each attempt
+            stream = update['files'][1]
+            if hasattr(stream, 'seek'):
+                stream.seek(0)
+            return MultipartEncoder(fields=update, boundary=boundary)
+
+        headers['Content-Type'] = 'multipart/form-data; boundary={}'.format(boundary)
+    elif isinstance(update, dict):
+        update['roomId'] = context['spark']['id']
+        payload = update
+    else:
+        payload = {'roomId': context['spark']['id'], 'text': update }
+
+    response = get_spark(context).post(url=url, headers=headers, data=payload, priority=0)
+
+    if (isinstance(payload, dict) and isinstance(payload.get('files'), HostedFile)
+            and 400 <= response.status_code < 500 and response.status_code != 429):
+        logging.warning("- unable to use hosted copy at '{}'".format(payload['files']))
+        drop_hosted_url(payload['files'])
+        return post_update(context, dict(update, files=payload['files'].upload))
+
+    if response.status_code != 200:
+        logging.info(response.json())
+        raise Exception("Received error code {}".format(response.status_code))
+
+    logging.info('- done, check the room with Cisco Spark client software')
+
+# updates of rooms that are combined, for each thread
+#
+outbox = threading.local()
+
+@contextlib.contextmanager
+def batch_updates(context):
+    """
+    Combines updates posted to rooms while a push is processed
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    Text of updates is kept for each room, and then posted as a single
+    Markdown message when the push has been processed.
+    """
+
+    if getattr(outbox, 'rooms', None) is not None:  # batch started already
+        yield
+        return
+
+    outbox.rooms = collections.OrderedDict()
+    try:
+        yield
+
+    finally:
+        rooms, outbox.rooms = outbox.rooms, None
+
+        for room_id, lines in rooms.items():
+            logging.info("- combining {} updates".format(len(lines)))
+            spark = dict(context['spark'], id=room_id)
+            post_update(dict(context, spark=spark), {'markdown': '\n\n'.join(lines)})
+
+def keep_update(context, update):
+    """
+    Keeps an update of a room for later
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :param update: content of the update
+    :type update: ``str`` or ``dict``
+
+    :return: True if the update has been kept, False if it has to be posted
+    :rtype: ``bool``
+
+    """
+
+    rooms = getattr(outbox, 'rooms', None)
+    if rooms is None:
+        return False
+
+    if isinstance(update, dict):
+        if update.get('files') is not None:
+            return False
+
+        line = update.get('markdown') or update.get('text')
+
+    else:
+        line = update
+
+    if line and line.strip():
+        rooms.setdefault(context['spark']['id'], []).append(line.strip())
+
+    return True
+
+#
+# remember Cisco Spark rooms across pushes and restarts
+#
+
+rooms = None
+rooms_lock = threading.RLock()
+
+def get_rooms_path():
+    """
+    Locates the file where room ids are saved
+    """
+
+    return os.path.abspath(os.path.dirname(__file__))+'/.rooms'
+
+def load_rooms():
+    """
+    Loads the cache of room ids from the disk
+
+    :return: the id of the room for each button
+    :rtype: ``dict``
+
+    """
+
+    global rooms
+
+    with rooms_lock:
+        try:
+            with open(get_rooms_path(), 'r') as stream:
+                rooms = yaml.load(stream, Loader=yaml_loader)
+
+        except IOError:
+            rooms = None
+
+        except Exception as feedback:
+            logging.error(str(feedback))
+            rooms = None
+
+        if not isinstance(rooms, dict):
+            rooms = {}
+
+        return rooms
+
+def save_rooms():
+    """
+    Saves the cache of room ids to the disk
+    """
+
+    try:
+        dump_yaml(rooms, get_rooms_path())
+
+    except (IOError, OSError) as feedback:
+        logging.error("Unable to save room ids")
+        logging.error(str(feedback))
+
+# rooms are looked for or created by one thread at a time for each button,
+# with locks that are not used for the counting of pushes
+#
+room_locks = [threading.RLock() for index in range(64)]
+
+def lock_room(name):
+    """
+    Provides the lock that serialises the search and creation of a room
+
+    :param name: the button identifier
+    :type name: ``str``
+
+    :return: a re-entrant lock shared with a few other buttons
+    :rtype: ``threading.RLock``
+
+    This lock is held during calls to Cisco Spark, therefore it is not the
+    one that protects the state of the button.
+    """
+
+    return room_locks[hash(name) % len(room_locks)]
+
+@contextlib.contextmanager
+def lock_rooms(context):
+    """
+    Serialises the search and the creation of rooms across processes
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    When requests are served by several processes, an exclusive lock is
+    set on the file `.rooms.lock`, and the cache of room ids is reloaded so
+    that rooms created by other processes are found there.
+    """
+
+    if fcntl is None or int(context['server'].get('workers', 1)) < 2:
+        yield
+        return
+
+    with open(get_rooms_path()+'.lock', 'a') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            load_rooms()
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+def get_cached_room(name):
+    """
+    Provides the id of the room used by a button, if any
+
+    :param name: the button identifier
+    :type name: ``str``
+
+    :return: the id of the room, or None
+    :rtype: ``str``
+
+    """
+
+    with rooms_lock:
+        if rooms is None:
+            load_rooms()
+
+        return rooms.get(name)
+
+def remember_room(name, room_id):
+    """
+    Remembers the room used by a button
+
+    :param name: the button identifier
+    :type name: ``str``
+
+    :param room_id: the id of the Cisco Spark room
+    :type room_id: ``str``
+
+    """
+
+    with rooms_lock:
+        if rooms is None:
+            load_rooms()
+
+        if rooms.get(name) != room_id:
+            rooms[name] = room_id
+            save_rooms()
+
+def forget_room(name, room_id=None):
+    """
+    Forgets the room used by a button
+
+    :param name: the button identifier
+    :type name: ``str``
+
+    :param room_id: forget the room only if it is still this one
+    :type room_id: ``str``
+
+    """
+
+    with rooms_lock:
+        if rooms is None:
+            load_rooms()
+
+        if room_id is not None and rooms.get(name) != room_id:
+            return
+
+        if rooms.pop(name, None) is not None:
+            save_rooms()
+
+#
+# state of escalations across restarts and processes
+#
+
+def next_count(count, last, reset, now, debounce=None):
+    """
+    Computes the rank of a new push in the escalation
+
+    :param count: the number of previous pushes
+    :type count: ``int``
+
+    :param last: the time of the previous push, or None
+    :type last: ``float``
+
+    :param reset: seconds after which the escalation restarts, or None
+    :type reset: ``int``
+
+    :param now: the time of the new push
+    :type now: ``float``
+
+    :param debounce: seconds during which a new push is the same as the
+        previous one, or None
+    :type debounce: ``float``
+
+    :return: the rank of the new push, or None if it has been coalesced
+    :rtype: ``int``
+
+    """
+
+    if debounce is not None and last is not None and now - last < debounce:
+        return None
+
+    if reset is not None and last is not None and now - last > reset:
+        return 1
+
+    return count + 1
+
+# buttons are spread over a fixed set of locks, so that pushes of different
+# buttons rarely wait for each other
+#
+button_locks = [threading.RLock() for index in range(64)]
+
+def lock_button(name):
+    """
+    Provides the lock that protects the state of a button
+
+    :param name: the button identifier
+    :type name: ``str``
+
+    :return: a re-entrant lock shared with a few other buttons
+    :rtype: ``threading.RLock``
+
+    """
+
+    return button_locks[hash(name) % len(button_locks)]
+
+class MemoryState(object):
+    """
+    Keeps the state of each button in its context
+
+    This is the default store. State is lost on restart, and is not shared
+    across processes.
+
+    A push on a context that has been replaced by a reload in the meantime
+    is counted on the new context, and the state is copied back to the
+    previous context.
+    """
+
+    def __init__(self):
+        self.counted = {}  # last push of each button, that can be cancelled
+
+    def load(self, context):
+        context.setdefault('count', 0)
+
+    def push(self, context, reset=None, now=None, debounce=None):
+        if now is None:
+            now = time.time()
+
+        with lock_button(context['name']):
+            live = get_successor(context)
+            count = next_count(live['count'], live.get('time'), reset, now, debounce)
+            if count is not None:
+                self.counted[ context['name'] ] = (count, now, live['count'], live.get('time'))
+                live['count'] = count
+                live['time'] = now
+            if live is not context:
+                preserve_state(live, context)
+            return count
+
+    def cancel(self, context, count):
+        with lock_button(context['name']):
+            live = get_successor(context)
+            done = self.counted.get(context['name'])
+            if done is None or done[:2] != (count, live.get('time')) or live['count'] != count:
+                return False
+
+            del self.counted[ context['name'] ]
+            for item in (context, live):
+                item['count'] = done[2]
+                if done[3] is None:
+                    item.pop('time', None)
+                else:
+                    item['time'] = done[3]
+            return True
+
+    def clear(self, context):
+        with lock_button(context['name']):
+            self.counted.pop(context['name'], None)
+            for item in (context, get_successor(context)):
+                item['count'] = 0
+                item.pop('time', None)
+
+class SqliteState(object):
+    """
+    Saves the state of each button in a SQLite database
+
+    The database is written in write-ahead mode, and synced to the disk only
+    at checkpoints, so that a push is a short append to the log. Pushes are
+    counted in an immediate transaction, which serialises processes that
+    share the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.counted = {}  # last push of each button, that can be cancelled
+
+        self.connect().execute('CREATE TABLE IF NOT EXISTS pushes '
+                               '(name TEXT PRIMARY KEY, count INTEGER NOT NULL, time REAL)')
+
+    def connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+
+        return connection
+
+    def load(self, context):
+        row = self.connect().execute('SELECT count, time FROM pushes WHERE name=?',
+                                     (context['name'],)).fetchone()
+        if row is None:
+            row = (0, None)
+
+        context['count'] = row[0]
+        if row[1] is None:
+            context.pop('time', None)
+        else:
+            context['time'] = row[1]
+
+    def push(self, context, reset=None, now=None, debounce=None):
+        if now is None:
+            now = time.time()
+
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT count, time FROM pushes WHERE name=?',
+                                     (context['name'],)).fetchone()
+            if row is None:
+                row = (0, None)
+
+            count = next_count(row[0], row[1], reset, now, debounce)
+            if count is not None:
+                connection.execute('INSERT OR REPLACE INTO pushes (name, count, time) VALUES (?, ?, ?)',
+                                   (context['name'], count, now))
+            connection.execute('COMMIT')
+
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        if count is not None:
+            self.counted[ context['name'] ] = (count, now, row[0], row[1])
+            context['count'] = count
+            context['time'] = now
+        return count
+
+    def cancel(self, context, count):
+        done = self.counted.get(context['name'])
+        if done is None or done[0] != count:
+            return False
+
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT count, time FROM pushes WHERE name=?',
+                                     (context['name'],)).fetchone()
+
+            cancelled = row is not None and tuple(row) == done[:2]
+            if cancelled:
+                connection.execute('INSERT OR REPLACE INTO pushes (name, count, time) VALUES (?, ?, ?)',
+                                   (context['name'], done[2], done[3]))
+            connection.execute('COMMIT')
+
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        if cancelled:
+            self.counted.pop(context['name'], None)
+            context['count'] = done[2]
+            if done[3] is None:
+                context.pop('time', None)
+            else:
+                context['time'] = done[3]
+        return cancelled
+
+    def clear(self, context):
+        self.counted.pop(context['name'], None)
+        self.connect().execute('DELETE FROM pushes WHERE name=?', (context['name'],))
+        context['count'] = 0
+        context.pop('time', None)
+
+class RedisState(object):
+    """
+    Saves the state of each button in a Redis server
+
+    Each button is a hash with fields `count` and `time`. A push is counted
+    in an optimistic transaction, which is retried if another process has
+    changed the hash in the meantime.
+    """
+
+    def __init__(self, url=None, client=None, prefix='button:'):
+        if client is None:
+            if redis is None:
+                raise ValueError("Install redis to save the state of buttons in Redis")
+            client = redis.StrictRedis.from_url(url)
+
+        self.client = client
+        self.prefix = prefix
+        self.counted = {}  # last push of each button, that can be cancelled
+
+    def load(self, context):
+        count, last = self.client.hmget(self.prefix+context['name'], 'count', 'time')
+
+        context['count'] = int(count or 0)
+        if last is None:
+            context.pop('time', None)
+        else:
+            context['time'] = float(last)
+
+    def push(self, context, reset=None, now=None, debounce=None):
+        if now is None:
+            now = time.time()
+
+        outcome = {}
+
+        def update(pipe):
+            count, last = pipe.hmget(self.prefix+context['name'], 'count', 'time')
+            if last is not None:
+                last = float(last)
+
+            outcome['count'] = next_count(int(count or 0), last, reset, now, debounce)
+            outcome['previous'] = (int(count or 0), last)
+
+            pipe.multi()
+            if outcome['count'] is not None:
+                pipe.hmset(self.prefix+context['name'], {'count': outcome['count'], 'time': repr(now)})
+
+        self.client.transaction(update, self.prefix+context['name'])
+
+        if outcome['count'] is not None:
+            self.counted[ context['name'] ] = (outcome['count'], now)+outcome['previous']
+            context['count'] = outcome['count']
+            context['time'] = now
+        return outcome['count']
+
+    def cancel(self, context, count):
+        done = self.counted.get(context['name'])
+        if done is None or done[0] != count:
+            return False
+
+        outcome = {}
+
+        def update(pipe):
+            current, last = pipe.hmget(self.prefix+context['name'], 'count', 'time')
+            outcome['cancelled'] = last is not None and (int(current), float(last)) == done[:2]
+
+            pipe.multi()
+            if outcome['cancelled'] and done[3] is None:
+                pipe.delete(self.prefix+context['name'])
+            elif outcome['cancelled']:
+                pipe.hmset(self.prefix+context['name'], {'count': done[2], 'time': repr(done[3])})
+
+        self.client.transaction(update, self.prefix+context['name'])
+
+        if outcome['cancelled']:
+            self.counted.pop(context['name'], None)
+            context['count'] = done[2]
+            if done[3] is None:
+                context.pop('time', None)
+            else:
+                context['time'] = done[3]
+        return outcome['cancelled']
+
+    def clear(self, context):
+        self.counted.pop(context['name'], None)
+        self.client.delete(self.prefix+context['name'])
+        context['count'] = 0
+        context.pop('time', None)
+
+state_store = None
+state_lock = threading.Lock()
+
+def get_state(context):
+    """
+    Provides the store where the state of buttons is kept
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :return: a store shared by all buttons
+
+    The store is selected with `state:` in the `server:` section of the
+    configuration: `memory` (the default), `sqlite` or `redis`.
+    """
+
+    global state_store
+
+    with state_lock:
+        if state_store is None:
+            state_store = open_state(context['server'])
+
+    return state_store
+
+def open_state(server):
+    """
+    Opens a store for the state of buttons
+
+    :param server: the `server:` section of the configuration
+    :type server: ``dict``
+
+    """
+
+    kind = server.get('state', 'memory')
+
+    if kind == 'memory':
+        logging.info("Keeping the state of buttons in memory")
+        return MemoryState()
+
+    if kind == 'sqlite':
+        path = server.get('state_path',
+                          os.path.abspath(os.path.dirname(__file__))+'/.state')
+        logging.info("Saving the state of buttons in '{}'".format(path))
+        return SqliteState(path)
+
+    if kind == 'redis':
+        url = server.get('state_url', 'redis://localhost:6379/0')
+        logging.info("Saving the state of buttons in '{}'".format(url))
+        return RedisState(url)
+
+    raise ValueError("Unknown state store '{}'".format(kind))
+
+#
+# run actions concurrently
+#
+
+def fan_out(action, items, workers=8):
+    """
+    Applies an action to several items concurrently
+
+    :param action: the function to call for each item
+    :type action: ``callable``
+
+    :param items: the items to process
+    :type items: ``list``
+
+    :param workers: the maximum number of concurrent calls
+    :type workers: ``int``
+
+    :return: the outcome of the action for each item, in the same order
+    :rtype: ``list``
+
+    Exceptions are not caught, therefore the action should report errors
+    in its outcome if other items have to be processed anyway.
+    """
+
+    items = list(items)
+    workers = min(int(workers), len(items))
+
+    if workers < 2:
+        return [action(item) for item in items]
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(action, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def summarize_outcomes(done, numbers, errors):
+    """
+    Reports on actions performed for several numbers
+
+    :param done: the beginning of the line listing successful actions
+    :type done: ``str``
+
+    :param numbers: the target numbers
+    :type numbers: ``list``
+
+    :param errors: the error for each number, or None on success
+    :type errors: ``list``
+
+    :return: a single Markdown update
+    :rtype: ``dict``
+
+    """
+
+    lines = []
+
+    succeeded = [number for number, error in zip(numbers, errors) if error is None]
+    if succeeded:
+        lines.append("{} '{}'".format(done, ', '.join(succeeded)))
+
+    for number, error in zip(numbers, errors):
+        if error is not None:
+            lines.append("Error: {} for '{}'".format(error, number))
+
+    return { 'markdown': '\n\n'.join(lines) }
+
+#
+# handle Twilio API
+#
+
+twilio_clients = collections.OrderedDict()
+twilio_lock = threading.Lock()
+
+def get_twilio(context):
+    """
+    Provides a client of the Twilio API
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :return: a client bound to the credentials of the button
+    :rtype: ``TwilioRestClient``
+
+    Clients are cached per account and token, so that repeated escalations
+    for the same account do not build a new client each time. The least
+    recently used client is dropped when there are more than `clients:`
+    in the `twilio:` section of the configuration, and clients with former
+    credentials of an account are dropped as soon as the token changes.
+    """
+
+    account = context['twilio']['TWILIO_ACCOUNT_SID']
+    token = context['twilio']['TWILIO_AUTH_TOKEN']
+    key = (account, token)
+
+    with twilio_lock:
+        handle = twilio_clients.pop(key, None)
+
+        if handle is None:
+            for former in [item for item in twilio_clients if item[0] == account]:
+                logging.debug("Forgetting former credentials of Twilio account")
+                del twilio_clients[former]
+
+            handle = TwilioRestClient(account, token,
+                                      timeout=context['twilio'].get('timeout', 30))
+
+        twilio_clients[key] = handle
+
+        while len(twilio_clients) > int(context['twilio'].get('clients', 8)):
+            twilio_clients.popitem(last=False)
+
+    return handle
+
+def send_sms(context, details):
+    """"
+    Sends a SMS to target people
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :param details: what to send and to which numbers
+    :type details: ``Sms`` or ``list``
+
+    This function uses the Twilio API to send a SMS message to target people
+    """
+    logging.info("- sending a SMS")
+
+    if not isinstance(details, Sms):
+        try:
+            details = compile_sms(context, details)
+
+        except ValueError as feedback:
+            logging.error(str(feedback))
+            update = { 'markdown': 'Error: Unable to send a SMS - check configuration'}
+            post_update(context, update)
+            return
+
+    handle = get_twilio(context)
+
+    message = details.message
+    from_number = details.from_number
+    to_numbers = list(details.numbers)
+
+    logging.info("- sending '{}'".format(message))
+
+    def send(number):
+        logging.info("- sending to '{}'".format(number))
+
+        try:
+            call_resilient(context['twilio'], 'twilio/messages',
+                           lambda: handle.messages.create(body=message,
+                                                          to=number,
+                                                          from_=from_number),
+                           check_twilio)
+
+        except CircuitOpenError as feedback:
+            logging.error(str(feedback))
+            return 'Twilio API is not available'
+
+        except socket.error as feedback:
+            logging.error("Unable to communicate with Twilio API endpoint")
+            logging.error(str(feedback))
+            return 'Unable to communicate with Twilio API endpoint'
+
+        except TwilioRestException as feedback:
+            logging.error("Receive Exception from Twilio API")
+            logging.error(str(feedback))
+            return 'Receive Exception from Twilio API'
+
+        except Exception as feedback:
+            logging.error("Unable to use Twilio API")
+            logging.exception(feedback)
+            return 'Unable to use Twilio API'
+
+    errors = fan_out(send, to_numbers, context['twilio'].get('workers', 8))
+
+    update = summarize_outcomes("SMS '{}' has been sent to".format(message),
+                                to_numbers, errors)
+    post_update(context, update)
+
+def phone_call(context, details):
+    """"
+    Calls people
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :param details: what to say and which numbers to call
+    :type details: ``Call`` or ``list``
+
+    This function uses the Twilio API to call target people
+    """
+    logging.info("- passing a phone call")
+
+    if not isinstance(details, Call):
+        try:
+            details = compile_call(context, details)
+
+        except ValueError as feedback:
+            logging.error(str(feedback))
+            update = { 'markdown': 'Error: Unable to call - check configuration'}
+            post_update(context, update)
+            return
+
+    handle = get_twilio(context)
+
+    url = details.url
+    from_number = details.from_number
+    to_numbers = list(details.numbers)
+
+    if url is None:
+        if context['server']['url'] is None:
+            logging.error("Missing url: configuration information")
+            update = { 'markdown': 'Error: No URL for the call - check configuration'}
+            post_update(context, update)
+            return
+        url = context['server']['url'].rstrip('/')+'/call/'+encode_token(context, context['name'], action='call')
+
+    logging.info("- using '{}'".format(url))
+
+    def call(number):
+        logging.info("- calling '{}'".format(number))
+
+        try:
+            call_resilient(context['twilio'], 'twilio/calls',
+                           lambda: handle.calls.create(to=number,
+                                                       from_=from_number,
+                                                       url=url),
+                           check_twilio)
+
+        except CircuitOpenError as feedback:
+            logging.error(str(feedback))
+            return 'Twilio API is not available'
+
+        except socket.error as feedback:
+            logging.error("Unable to communicate with Twilio API endpoint")
+            logging.error(str(feedback))
+            return 'Unable to communicate with Twilio API endpoint'
+
+        except TwilioRestException as feedback:
+            logging.error("Receive Exception from Twilio API")
+            logging.error(str(feedback))
+            return 'Receive Exception from Twilio API'
+
+        except Exception as feedback:
+            logging.error("Unable to use Twilio API")
+            logging.exception(feedback)
+            return 'Unable to use Twilio API'
+
+    errors = fan_out(call, to_numbers, context['twilio'].get('workers', 8))
+
+    update = summarize_outcomes("Calling", to_numbers, errors)
+    post_update(context, update)
+
+@web.route("/call", method=['GET', 'POST'])
+@web.route("/call/<button>", method=['GET', 'POST'])
+def web_inbound_call(button=None):
+    """
+    Handles an inbound phone call
+
+    This function is called from twilio cloud back-end
+    """
+
+    if button is None:
+        button = settings['server']['default']
+
+    logging.info("Receiving inbound call for button '{}'".format(button))
+
+    try:
+        button = decode_token(settings, button, action='call')
+
+        context = load_button(settings, button)
+        get_state(context).load(context)
+
+        response.content_type = 'text/xml; charset=utf-8'
+        return get_twiml(context)
+
+    except Exception as feedback:
+        if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
+            logging.error("Unable to handle inbound call for '{}'".format(button))
+            raise
+        else:
+            logging.error(str(feedback))
+            response.status = 400
+            return 'Invalid request'
+
+def compile_twiml(plan):
+    """
+    Prepares answers to inbound calls
+
+    :param plan: steps of the button
+    :type plan: ``list`` of ``Step``
+
+    :return: TwiML of each step, and the default TwiML
+    :rtype: ``dict``
+
+    """
+
+    def render(say):
+        behaviour = twilio.twiml.Response()
+        behaviour.say(say or "What's up Doc?")
+        return str(behaviour)
+
+    return {'steps': [render(step.call.say if step.call is not None else None)
+                      for step in plan],
+            'default': render(None)}
+
+def get_twiml(context, count=None):
+    """
+    Provides the answer to an inbound call
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :param count: the rank of the push, else the current counter is used
+    :type count: ``int``
+
+    :return: TwiML prepared when the button has been loaded
+    :rtype: ``str``
+
+    """
+
+    if count is None:
+        count = context['count']
+
+    twiml = context['twiml']
+    if 0 < count < len(twiml['steps'])+1:
+        return twiml['steps'][count-1]
+
+    return twiml['default']
+
+#
+# actions compiled from the configuration of buttons
+#
+
+class Action(object):
+    """
+    Describes an action compiled from the configuration of a button
+
+    Actions are compiled once, when the button is loaded, and cannot be
+    modified afterwards.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("'{}' cannot be modified".format(type(self).__name__))
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+            ', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+class Step(Action):
+    """
+    What to do on one push of a button
+    """
+
+    __slots__ = ('markdown', 'message', 'file', 'label', 'type', 'sms', 'call')
+
+class Sms(Action):
+    """
+    A SMS message to be sent to some numbers
+    """
+
+    __slots__ = ('message', 'from_number', 'numbers')
+
+class Call(Action):
+    """
+    A phone call to be placed to some numbers
+    """
+
+    __slots__ = ('url', 'say', 'from_number', 'numbers')
+
+def compile_plan(context):
+    """
+    Compiles the `bt.tn:` configuration of a button
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :return: the step to execute for each push
+    :rtype: ``tuple`` of ``Step``
+
+    :raises: ``ValueError`` if the configuration is invalid
+
+    """
+
+    steps = []
+    for index, item in enumerate(context.get('bt.tn') or (), 1):
+
+        if not isinstance(item, dict):
+            raise ValueError("Invalid bt.tn: statement in step {}: '{}'".format(index, str(item)))
+
+        for key in item.keys():
+            if key not in Step.__slots__:
+                logging.warning("Ignoring '{}' in step {}".format(key, index))
+
+        if 'file' in item:
+            path = os.path.abspath(os.path.dirname(__file__))+'/'+item['file']
+            if not os.path.isfile(path):
+                raise ValueError("Missing file '{}' in step {}".format(item['file'], index))
+
+        steps.append(Step(markdown=item.get('markdown'),
+                          message=item.get('message'),
+                          file=item.get('file'),
+                          label=item.get('label'),
+                          type=item.get('type', 'application/octet-stream'),
+                          sms=compile_sms(context, item['sms']) if 'sms' in item else None,
+                          call=compile_call(context, item['call']) if 'call' in item else None))
+
+    return tuple(steps)
+
+def parse_statements(details, keywords, label):
+    """
+    Parses a list of statements, each with a single keyword
+
+    :param details: statements, e.g., ``[{'number': '+33...'}, ...]``
+    :type details: ``list``
+
+    :param keywords: accepted keywords
+    :type keywords: ``tuple``
+
+    :param label: the statement that is parsed, for error messages
+    :type label: ``str``
+
+    :return: a list of (keyword, value)
+    :rtype: ``list`` of ``tuple``
+
+    :raises: ``ValueError`` if some statement is invalid
+
+    """
+
+    if not isinstance(details, list):
+        raise ValueError("Invalid {}: configuration: '{}'".format(label, str(details)))
+
+    statements = []
+    for line in details:
+        if not isinstance(line, dict) or len(line) != 1:
+            raise ValueError("Invalid {}: statement: '{}'".format(label, str(line)))
+
+        keyword, value = list(line.items())[0]
+        if keyword not in keywords:
+            raise ValueError("Invalid {}: statement: '{}'".format(label, str(line)))
+
+        statements.append((keyword, value))
+
+    return statements
+
+def compile_sms(context, details):
+    """
+    Compiles the `sms:` configuration of a step
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :param details: what to send and to which numbers
+    :type details: ``list``
+
+    :return: the SMS to send
+    :rtype: ``Sms``
+
+    :raises: ``ValueError`` if the configuration is invalid
+
+    """
+
+    message = ''
+    from_number = context['twilio'].get('customer_service_number')
+    numbers = []
+
+    for keyword, value in parse_statements(details, ('message', 'from', 'number'), 'sms'):
+        if keyword == 'message':
+            message = value
+
+        elif keyword == 'from':
+            from_number = value
+
+        else:
+            numbers.append(value)
+
+    if len(message) < 4:
+        raise ValueError("SMS message should have at least 4 characters: '{}'".format(str(message)))
+
+    if len(numbers) < 1:
+        raise ValueError("No target phone number for SMS")
+
+    if from_number is None:
+        from_number = numbers[0]
+
+    return Sms(message=message,
+               from_number=from_number,
+               numbers=tuple(numbers))
+
+def compile_call(context, details):
+    """
+    Compiles the `call:` configuration of a step
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :param details: what to say and which numbers to call
+    :type details: ``list``
+
+    :return: the call to place
+    :rtype: ``Call``
+
+    :raises: ``ValueError`` if the configuration is invalid
+
+    If no `url:` is provided, the call is handled by this server, and the url
+    is computed when the call is placed.
+    """
+
+    url = None
+    say = None
+    from_number = context['twilio'].get('customer_service_number')
+    numbers = []
+
+    for keyword, value in parse_statements(details, ('url', 'say', 'from', 'number'), 'call'):
+        if keyword == 'url':
+            if len(value) < 4:
+                raise ValueError("Invalid url for call: '{}'".format(str(value)))
+            url = value
+
+        elif keyword == 'say':
+            say = value
+
+        elif keyword == 'from':
+            from_number = value
+
+        else:
+            numbers.append(value)
+
+    if len(numbers) < 1:
+        raise ValueError("No target phone number for call")
+
+    if from_number is None:
+        from_number = numbers[0]
+
+    return Call(url=url,
+                say=say,
+                from_number=from_number,
+                numbers=tuple(numbers))
+
+#
+# snapshot of parsed configuration files
+#
+
+snapshot = None
+snapshot_changed = False
+snapshot_lock = threading.Lock()
+snapshot_version = 1
+
+def get_snapshot_path():
+    """
+    Locates the file where parsed configuration is saved
+    """
+
+    return os.path.abspath(os.path.dirname(__file__))+'/.snapshot'
+
+def load_snapshot():
+    """
+    Loads parsed configuration files saved on previous run
+
+    :return: the serialized content of each file, with its time and size
+    :rtype: ``dict``
+
+    """
+
+    global snapshot
+
+    try:
+        with open(get_snapshot_path(), 'rb') as stream:
+            content = pickle.load(stream)
+
+        if content.get('version') != snapshot_version:
+            raise ValueError('Unsupported version of snapshot')
+
+        snapshot = content['files']
+
+    except IOError:
+        snapshot = {}
+
+    except Exception as feedback:
+        logging.warning("Ignoring snapshot of configuration")
+        logging.warning(str(feedback))
+        snapshot = {}
+
+    return snapshot
+
+def save_snapshot():
+    """
+    Saves parsed configuration files, if some have changed
+
+    Entries of files that have been removed are dropped.
+    """
+
+    global snapshot_changed
+
+    with snapshot_lock:
+        if snapshot is None or not snapshot_changed:
+            return
+
+        for name in list(snapshot.keys()):
+            if not os.path.exists(os.path.abspath(os.path.dirname(__file__))+'/'+name):
+                del snapshot[name]
+
+        content = {'version': snapshot_version, 'files': dict(snapshot)}
+        snapshot_changed = False
+
+    path = get_snapshot_path()
+    handle = tempfile.NamedTemporaryFile('wb',
+                                         dir=os.path.dirname(path),
+                                         prefix=os.path.basename(path)+'.',
+                                         delete=False)
+    try:
+        with handle:
+            pickle.dump(content, handle, pickle.HIGHEST_PROTOCOL)
+        os.rename(handle.name, path)
+
+    except Exception as feedback:
+        logging.error("Unable to save snapshot of configuration")
+        logging.error(str(feedback))
+        os.remove(handle.name)
+
+def read_yaml(name):
+    """
+    Reads a configuration file
+
+    :param name: the file name, relative to the directory of the server
+    :type name: ``str``
+
+    :return: the parsed content
+    :rtype: ``dict``
+
+    Files are parsed only if they have been changed since last snapshot,
+    as detected by their modification time and size. Each call provides
+    a new object, so that callers can modify it at will.
+    """
+
+    global snapshot_changed
+
+    path = os.path.abspath(os.path.dirname(__file__))+'/'+name
+    stat = os.stat(path)
+    signature = (stat.st_mtime, stat.st_size)
+
+    with snapshot_lock:
+        if snapshot is None:
+            load_snapshot()
+
+        entry = snapshot.get(name)
+
+    if entry is not None and entry[0] == signature:
+        logging.debug("- using snapshot of {}".format(name))
+        return pickle.loads(entry[1])
+
+    with open(path, 'r') as stream:
+        content = yaml.load(stream, Loader=yaml_loader)
+
+    with snapshot_lock:
+        snapshot[name] = (signature, pickle.dumps(content, pickle.HIGHEST_PROTOCOL))
+        snapshot_changed = True
+
+    return content
+
+#
+# the collection of buttons that we manage
+#
+
+buttons = {}
+
+# use the fast and safe parser from libyaml if it is available
+#
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def load_buttons(settings, preserve=False):
+    """
+    Loads all buttons from the directory `buttons`
+
+    :param settings: generic settings
+    :type settings: ``dict``
+
+    :param preserve: keep buttons that have been loaded already
+    :type preserve: ``bool``
+
+    :return: all buttons
+    :rtype: ``dict``
+
+    Configuration files are parsed concurrently, with at most `load_workers:`
+    files at a time as set in the `server:` section of the configuration.
+    The new collection of buttons replaces the previous one at once.
+
+    If `preserve` is set, then new buttons are added one at a time to the
+    current collection instead, and buttons loaded in the meantime, e.g., on
+    requests received while the server is starting, are kept with their state.
+    """
+
+    global buttons
+
+    names = []
+    for there, unused, files in os.walk(os.path.abspath(os.path.dirname(__file__))+'/buttons'):
+        logging.debug("Walking %s", there)
+
+        for file in files:
+            logging.debug("Found file %s", file)
+            button, extension = file.split('.', 1)
+            if extension == 'yaml':
+                names.append(button)
+
+    def read(name):
+        try:
+            return read_button(name)
+        except Exception as feedback:
+            return feedback
+
+    loaded = {}
+    tokens = {}
+    for name, additions in zip(names, fan_out(read, names, settings['server'].get('load_workers', 8))):
+        try:
+            if isinstance(additions, Exception):
+                raise additions
+
+            loaded[ name ] = build_button(settings, name, additions)
+            tokens.update(compute_tokens(settings, name))
+
+        except Exception:
+            logging.error("Unable to load button '{}'".format(name))
+
+    if preserve:
+        for name, context in loaded.items():
+            with lock_button(name):
+                buttons.setdefault(name, context)
+
+    else:
+        buttons = loaded
+
+    # tokens are saved once for all buttons
+    #
+    update_tokens(settings, tokens, replace=True)
+    save_tokens(settings)
+
+    # speed up next start
+    #
+    save_snapshot()
+
+    return buttons
+
+def load_button(settings, name='incident'):
+    """
+    Loads settings that are specific to a button
+
+    :param settings: generic settings
+    :type settings: ``dict``
+
+    :param name: the button identifier
+    :type name: ``str``
+
+    :return: button settings
+    :rtype: ``dict``
+
+    This function uses generic settings, and adds any settings from the file
+    that is specific to the button.
+
+    In other terms, if the button ``hello`` is loaded, then the software
+    uses the file ``buttons/hello.yaml`` in combination with ``settings.yaml``
+
+    """
+
+    # memoization
+    #
+    global buttons
+    if name in buttons:
+        return buttons[ name ]
+
+    with lock_button(name):
+
+        # loaded by another thread in the meantime
+        #
+        if name in buttons:
+            return buttons[ name ]
+
+        # this button was unknown so far
+        #
+        context = build_button(settings, name, read_button(name))
+
+        # save button state and security token
+        #
+        buttons[ context['name'] ] = context
+
+        with tokens_lock:
+            update_tokens(settings, compute_tokens(settings, context['name']))
+            save_tokens(settings)
+
+        return context
+
+def read_button(name):
+    """
+    Reads the configuration file of a button
+
+    :param name: the button identifier
+    :type name: ``str``
+
+    :return: settings that are specific to the button
+    :rtype: ``dict``
+
+    """
+
+    name = 'buttons/'+name+'.yaml'
+
+    try:
+        logging.info('Loading configuration from {}'.format(name))
+        return read_yaml(name)
+    except Exception as feedback:
+        logging.error(str(feedback))
+        raise
+
+def build_button(settings, name, additions):
+    """
+    Combines generic settings with settings of a button
+
+    :param settings: generic settings
+    :type settings: ``dict``
+
+    :param name: the button identifier
+    :type name: ``str``
+
+    :param additions: settings that are specific to the button
+    :type additions: ``dict``
+
+    :return: button state and configuration
+    :rtype: ``dict``
+
+    Generic settings are not copied in depth. Each section of the button
+    is a new container, and values that it shares with generic settings are
+    never modified afterwards.
+    """
+
+    context = {}
+    for key, value in settings.items():
+        if key in ('tokens', 'labels'):
+            pass
+
+        elif isinstance(value, dict):
+            context[key] = dict(value)
+
+        elif isinstance(value, list):
+            context[key] = list(value)
+
+        else:
+            context[key] = value
+
+    context['name'] = name
+
+    if not isinstance(additions, dict):
+        logging.error('No configuration information in buttons/{}.yaml'.format(name))
+        raise ValueError('No configuration information')
+
+    for key in additions.keys():
+        if additions[key] is None:
+            pass
+
+        elif key not in context:
+            context[key] = additions[key]
+
+        elif isinstance(context[key], list):
+            context[key] += additions[key]
+
+        elif isinstance(context[key], dict):
+            context[key].update(additions[key])
+
+        else:
+            context[key] = additions[key]
+
+    if "bt.tn" not in context:
+        logging.error("Missing bt.tn: configuration information")
+
+    elif len(context['bt.tn']) < 1:
+        logging.error("Missing bt.tn: actions in configuration")
+
+    if "room" not in context['spark']:
+        logging.error("Missing room: configuration information")
+
+    if "moderators" not in context['spark']:
+        logging.error("Missing moderators: configuration information")
+
+    # compile actions once for all pushes
+    #
+    try:
+        context['plan'] = compile_plan(context)
+    except ValueError as feedback:
+        logging.error("Invalid configuration in buttons/{}.yaml".format(name))
+        logging.error(str(feedback))
+        raise
+
+    # answers to inbound calls
+    #
+    context['twiml'] = compile_twiml(context['plan'])
+
+    # map attachments in memory
+    #
+    for step in context['plan']:
+        if step.file is not None:
+            get_attachment(context, step.file)
+
+    # first push of this button, or the state saved by previous runs
+    #
+    get_state(context).load(context)
+
+    return context
+
+#
+# reload configuration files on change
+#
+
+def watch_configuration(settings):
+    """
+    Starts to watch configuration files
+
+    :param settings: generic settings
+    :type settings: ``dict``
+
+    Changes of `settings.yaml` and of files in `buttons` are detected with
+    inotify if `pyinotify` is installed, else by polling every
+    `watch_interval:` seconds, as set in the `server:` section of the
+    configuration.
+    """
+
+    watcher = threading.Thread(target=watch_loop,
+                               args=(settings,),
+                               name='watcher')
+    watcher.daemon = True
+    watcher.start()
+
+    return watcher
 
-    This function is called from twilio cloud back-end
+def watch_loop(settings):
+    """
+    Reloads configuration files when they are changed
     """
 
-    if button is None:
-        button = settings['server']['default']
+    interval = float(settings['server'].get('watch_interval', 2))
 
-    logging.info("Receiving inbound call for button '{}'".format(button))
+    base = os.path.abspath(os.path.dirname(__file__))
 
-    try:
-        button = decode_token(settings, button, action='call')
+    notifier = None
+    if pyinotify is not None:
+        manager = pyinotify.WatchManager()
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE
+                | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+        manager.add_watch(base, mask)
+        manager.add_watch(base+'/buttons', mask)
+        notifier = pyinotify.Notifier(manager, default_proc_fun=lambda event: None)
+        logging.info("Watching configuration files with inotify")
 
-        context = load_button(settings, button)
-        update, twilio_action = get_push_details(context)
+    else:
+        logging.info("Watching configuration files every {} seconds".format(interval))
 
-        response.content_type = 'text/xml'
-        behaviour = twilio.twiml.Response()
+    signatures = scan_configuration()
+    while True:
 
-        say = None
-        if 'call' in twilio_action:
-            for line in twilio_action['call']:
-                if line.keys()[0] == 'say':
-                    say = line['say']
-                    break
+        if notifier is None:
+            time.sleep(interval)
 
-        if say is None:
-            say = "What's up Doc?"
+        elif notifier.check_events(timeout=int(interval*1000)):
+            notifier.read_events()
+            notifier.process_events()
 
-        behaviour.say(say)
-        return str(behaviour)
+        current = scan_configuration()
+        if current == signatures:
+            continue
 
-    except Exception as feedback:
-        if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
-            logging.error("Unable to handle inbound call for '{}'".format(button))
-            raise
-        else:
-            logging.error(str(feedback))
-            response.status = 400
-            return 'Invalid request'
+        try:
+            settings = reload_configuration(settings, signatures, current)
+        except Exception as feedback:
+            logging.error("Unable to reload configuration")
+            logging.exception(feedback)
 
-#
-# the collection of buttons that we manage
-#
+        signatures = current
 
-buttons = {}
+def scan_configuration():
+    """
+    Lists configuration files with their modification time and size
 
-def load_buttons(settings):
+    :return: signature of each file
+    :rtype: ``dict``
 
-    global buttons
-    buttons = {}
+    """
 
-    for there, unused, files in os.walk(os.path.abspath(os.path.dirname(__file__))+'/buttons'):
-        logging.debug("Walking %s", there)
+    base = os.path.abspath(os.path.dirname(__file__))
 
-        for file in files:
-            logging.debug("Found file %s", file)
-            button, extension = file.split('.', 1)
-            if extension == 'yaml':
-                buttons[ button ] = load_button(settings, button)
+    names = ['settings.yaml']
+    names += ['buttons/'+file for file in os.listdir(base+'/buttons') if file.endswith('.yaml')]
 
-    return buttons
+    signatures = {}
+    for name in names:
+        try:
+            stat = os.stat(base+'/'+name)
+            signatures[name] = (stat.st_mtime, stat.st_size)
+        except OSError:
+            pass
 
-def load_button(settings, name='incident'):
+    return signatures
+
+def reload_configuration(settings, before, after):
     """
-    Loads settings that are specific to a button
+    Reloads configuration files that have been changed
 
     :param settings: generic settings
     :type settings: ``dict``
 
-    :param name: the button identifier
-    :type name: ``str``
+    :param before: signatures of files on previous scan
+    :type before: ``dict``
 
-    :return: button settings
-    :rtype: ``dict``
+    :param after: signatures of files on this scan
+    :type after: ``dict``
 
-    This function uses generic settings, and adds any settings from the file
-    that is specific to the button.
+    :return: generic settings, that may have been reloaded
+    :rtype: ``dict``
 
-    In other terms, if the button ``hello`` is loaded, then the software
-    uses the file ``buttons/hello.yaml`` in combination with ``settings.yaml``
+    Buttons are rebuilt from their files, and swapped one at a time with
+    previous buttons, without losing the count and time of previous pushes.
+    Pushes counted on a previous button after the swap are forwarded to the
+    new one. If generic settings are changed, then all buttons are rebuilt.
 
+    Security tokens are computed only for new buttons, unless the key has
+    been changed. Previous settings are kept if the new file is invalid.
     """
 
-    # memoization
-    #
-    global buttons
-    if name in buttons:
-        return buttons[ name ]
+    key = settings['server'].get('key')
 
-    # this button was unknown so far
-    #
-    context = copy.deepcopy(settings)
+    reset = before.get('settings.yaml') != after.get('settings.yaml')
+    if reset:
+        try:
+            read_yaml('settings.yaml')  # configure() would stop the server
+        except (IOError, yaml.YAMLError) as feedback:
+            logging.error("Keeping previous settings")
+            logging.error(str(feedback))
+            reset = False
 
-    context['name'] = name
+    if reset:
+        logging.info("Reloading generic settings")
+        fresh = configure()
+        fresh['tokens'] = settings.get('tokens', {})
+        fresh['labels'] = settings.get('labels', {})
+        settings = fresh
+        install_settings(settings)
 
-    name = 'buttons/'+name+'.yaml'
+    renew = settings['server'].get('key') != key
 
-    try:
-        logging.info('Loading configuration from {}'.format(name))
-        with open(os.path.abspath(os.path.dirname(__file__))+'/'+name, 'r') as stream:
-            additions = yaml.load(stream)
-    except Exception as feedback:
-        logging.error(str(feedback))
-        raise
+    changed = [name for name in after
+               if name.startswith('buttons/') and (reset or before.get(name) != after[name])]
+    removed = [name for name in before
+               if name.startswith('buttons/') and name not in after]
 
-    if not isinstance(additions, dict):
-        logging.error('No configuration information in {}'.format(name))
-        return context
+    tokens = {}
 
-    for key in additions.keys():
-        if additions[key] is None:
-            pass
+    for name in changed:
+        button = name[len('buttons/'):-len('.yaml')]
 
-        elif key not in context:
-            context[key] = additions[key]
+        try:
+            context = build_button(settings, button, read_button(button))
+        except Exception:
+            logging.error("Unable to reload button '{}'".format(button))
+            continue
 
-        elif isinstance(context[key], list):
-            context[key] += additions[key]
+        # pushes of this button wait until the new context is installed
+        #
+        with lock_button(button):
+            former = buttons.get(button)
+            if former is None:
+                logging.info("Adding button '{}'".format(button))
+                tokens.update(compute_tokens(settings, button))
+            else:
+                logging.info("Reloading button '{}'".format(button))
+                preserve_state(former, context)
+                former['successor'] = context
 
-        elif isinstance(context[key], dict):
-            context[key].update(additions[key])
+            buttons[ button ] = context
 
-        else:
-            context[key] = additions[key]
+    for name in removed:
+        button = name[len('buttons/'):-len('.yaml')]
+        logging.info("Removing button '{}'".format(button))
+        with lock_button(button):
+            buttons.pop(button, None)
 
-    if "bt.tn" not in context:
-        logging.error("Missing bt.tn: configuration information")
+    touch_index()
 
-    if len(context['bt.tn']) < 1:
-        logging.error("Missing bt.tn: actions in configuration")
+    if renew:
+        generate_tokens(settings, buttons.keys())
 
-    if "room" not in context['spark']:
-        logging.error("Missing room: configuration information")
+    elif tokens or removed:
+        current = dict(settings.get('tokens', {}))
+        for name in removed:
+            button = name[len('buttons/'):-len('.yaml')]
+            for label in (button, button+'-call', button+'-delete', button+'-initialise'):
+                current.pop(label, None)
+        current.update(tokens)
+        update_tokens(settings, current, replace=True)
+        save_tokens(settings)
 
-    if "moderators" not in context['spark']:
-        logging.error("Missing moderators: configuration information")
+    save_snapshot()
 
-    # first push of this button
-    #
-    context['count'] = 0
+    return settings
 
-    # save button state and security token
-    #
-    buttons[ context['name'] ] = context
-    generate_tokens(settings, buttons.keys())
+def preserve_state(former, context):
+    """
+    Moves the state of a button to a new configuration
+
+    :param former: previous state and configuration of the button
+    :type former: ``dict``
+
+    :param context: new configuration of the button
+    :type context: ``dict``
+
+    """
+
+    for key in ('count', 'time'):
+        if key in former:
+            context[key] = former[key]
+
+def get_successor(context):
+    """
+    Provides the context that has replaced a button on reload
+
+    :param context: button state and configuration
+    :type context: ``dict``
+
+    :return: the current context of the button
+    :rtype: ``dict``
+
+    """
+
+    while 'successor' in context:
+        context = context['successor']
 
     return context
 
+def install_settings(fresh):
+    """
+    Changes generic settings used by the server
+    """
+
+    global settings
+    settings = fresh
+
 #
 # server management
 #
@@ -851,18 +3529,18 @@ def configure(name="settings.yaml"):
     :rtype: ``dict``
 
     The function loads configuration from the file and from the environment.
-    Port number can be set from the command line.
+    Port number can be set from the command line. Options such as
+    ``--async`` are not considered here.
 
     """
 
     logging.info('Loading configuration from {}'.format(name))
 
-    with open(os.path.abspath(os.path.dirname(__file__))+'/'+name, 'r') as stream:
-        try:
-            settings = yaml.load(stream)
-        except Exception as feedback:
-            logging.error(str(feedback))
-            sys.exit(1)
+    try:
+        settings = read_yaml(name)
+    except yaml.YAMLError as feedback:
+        logging.error(str(feedback))
+        sys.exit(1)
 
     if "spark" not in settings:
         logging.error("Missing spark: configuration information")
@@ -899,9 +3577,10 @@ def configure(name="settings.yaml"):
     if "server" not in settings:
         logging.error("Missing server: configuration information")
 
-    if len(sys.argv) > 1:
+    arguments = [item for item in sys.argv[1:] if not item.startswith('--')]
+    if len(arguments) > 0:
         try:
-            port_number = int(sys.argv[1])
+            port_number = int(arguments[0])
         except:
             logging.error("Invalid port_number specified")
     elif "port" in settings['server']:
@@ -939,29 +3618,24 @@ def encode_token(settings, label=None, action=None):
 
     return base64.b64encode(label+':'+hash)
 
+rejected_tokens = collections.OrderedDict()
+rejected_lock = threading.Lock()
+
 def decode_token(settings, token, action=None):
     """
     Decodes button name from a security token
+
+    Tokens generated for known buttons are found with a simple lookup.
+    Other tokens are checked with a new hash computation, and rejected tokens
+    are remembered, so that repeated attempts are rejected quickly.
     """
 
     if 'key' not in settings['server']:
         return token
 
-    try:
-        label, hash = base64.b64decode(token).split(':', 1)
-    except TypeError as feedback:
-        logging.error('Incorrect encoding of the security token')
-        raise Exception('Invalid security token')
-    except ValueError as feedback:
-        logging.error('No hash in security token')
-        raise Exception('Invalid security token')
-
-    expected = base64.b64encode(
-        hmac.new(settings['server']['key'], label).digest())
-
-    if hash != expected:
-        logging.error('Incorrect hash in security token')
-        raise Exception('Invalid security token')
+    label = settings.get('labels', {}).get(token)
+    if label is None:
+        label = check_token(settings, token)
 
     if action is None:
         return label
@@ -978,28 +3652,333 @@ def decode_token(settings, token, action=None):
 
     return items[0]
 
+def check_token(settings, token):
+    """
+    Checks the hash of a security token
+
+    :return: the label of the token
+    :rtype: ``str``
+
+    The size of the cache of rejected tokens is set with `rejected_tokens:`
+    in the `server:` section of the configuration.
+    """
+
+    key = (settings['server']['key'], token)
+
+    with rejected_lock:
+        if key in rejected_tokens:
+            logging.error('Security token has been rejected previously')
+            raise Exception('Invalid security token')
+
+    try:
+        try:
+            label, hash = base64.b64decode(token).split(':', 1)
+        except TypeError as feedback:
+            logging.error('Incorrect encoding of the security token')
+            raise Exception('Invalid security token')
+        except ValueError as feedback:
+            logging.error('No hash in security token')
+            raise Exception('Invalid security token')
+
+        expected = base64.b64encode(
+            hmac.new(settings['server']['key'], label).digest())
+
+        if not hmac.compare_digest(hash, expected):
+            logging.error('Incorrect hash in security token')
+            raise Exception('Invalid security token')
+
+    except Exception:
+        with rejected_lock:
+            rejected_tokens[key] = True
+            while len(rejected_tokens) > int(settings['server'].get('rejected_tokens', 1024)):
+                rejected_tokens.popitem(last=False)
+        raise
+
+    return label
+
 def generate_tokens(settings, buttons):
+    """
+    Generates security tokens for a set of buttons
+
+    :param settings: generic settings
+    :type settings: ``dict``
+
+    :param buttons: the buttons to consider
+    :type buttons: ``list`` of ``str``
+
+    :return: all security tokens
+    :rtype: ``dict``
+
+    Tokens of other buttons are forgotten, and the file `.tokens` is updated.
+    """
 
     tokens = {}
     for button in buttons:
+        tokens.update(compute_tokens(settings, button))
+
+    update_tokens(settings, tokens, replace=True)
+    save_tokens(settings)
+
+    return settings['tokens']
 
-        tokens[button] = encode_token(settings, button)
+def compute_tokens(settings, button):
+    """
+    Computes security tokens of a single button
+
+    :param settings: generic settings
+    :type settings: ``dict``
 
-        tokens[button+'-call'] = encode_token(settings, button, action='call')
+    :param button: the button identifier
+    :type button: ``str``
+
+    :return: tokens for the button and for each action
+    :rtype: ``dict``
+
+    """
 
-        tokens[button+'-delete'] = encode_token(settings, button, action='delete')
+    tokens = {}
 
-        tokens[button+'-initialise'] = encode_token(settings, button, action='initialise')
+    tokens[button] = encode_token(settings, button)
 
-    tokens['index'] = encode_token(settings, 'index')
+    tokens[button+'-call'] = encode_token(settings, button, action='call')
 
-    settings['tokens'] = tokens
+    tokens[button+'-delete'] = encode_token(settings, button, action='delete')
 
-    with open(os.path.abspath(os.path.dirname(__file__))+'/.tokens', 'w') as handle:
-        yaml.dump(tokens, handle, default_flow_style=False)
+    tokens[button+'-initialise'] = encode_token(settings, button, action='initialise')
 
     return tokens
 
+tokens_lock = threading.RLock()
+
+def update_tokens(settings, tokens, replace=False):
+    """
+    Updates security tokens used by the server
+
+    :param settings: generic settings
+    :type settings: ``dict``
+
+    :param tokens: new tokens
+    :type tokens: ``dict``
+
+    :param replace: forget tokens of other buttons
+    :type replace: ``bool``
+
+    New dictionaries are built and then swapped, so that requests that are
+    processed in the meantime never see partial updates.
+    """
+
+    with tokens_lock:
+        if replace:
+            tokens = dict(tokens)
+        else:
+            tokens = dict(settings.get('tokens', {}), **tokens)
+
+        tokens['index'] = encode_token(settings, 'index')
+
+        settings['labels'] = dict((token, label) for label, token in tokens.items())
+        settings['tokens'] = tokens
+
+    touch_index()
+
+def save_tokens(settings):
+    """
+    Saves security tokens in the file `.tokens`
+    """
+
+    with tokens_lock:
+        dump_yaml(settings['tokens'],
+                  os.path.abspath(os.path.dirname(__file__))+'/.tokens')
+
+def dump_yaml(data, path):
+    """
+    Saves data to a YAML file
+
+    :param data: the content to save
+    :type data: ``dict``
+
+    :param path: the full path of the file
+    :type path: ``str``
+
+    Data is written to a temporary file that then replaces the target file,
+    so that readers never get a partial file.
+    """
+
+    handle = tempfile.NamedTemporaryFile('w',
+                                         dir=os.path.dirname(path),
+                                         prefix=os.path.basename(path)+'.',
+                                         delete=False)
+    try:
+        with handle:
+            yaml.dump(data, handle, default_flow_style=False)
+        os.rename(handle.name, path)
+
+    except Exception:
+        os.remove(handle.name)
+        raise
+
+#
+# serve requests from several processes
+#
+
+class ListenerServer(WSGIRefServer):
+    """
+    Serves web requests from a socket that has been bound already
+
+    Use the option `listener` to provide the socket. Requests are processed
+    in separate threads, or in greenlets with --async.
+    """
+
+    def run(self, app):
+        listener = self.options.pop('listener')
+
+        if cooperative:
+            from gevent.pywsgi import WSGIServer as GeventServer
+            self.srv = GeventServer(listener, app, log=None if self.quiet else 'default')
+            self.srv.serve_forever()
+            return
+
+        class Server(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+            def server_bind(self):
+                self.socket.close()
+                self.socket = listener
+                self.server_address = listener.getsockname()
+                host, port = self.server_address[:2]
+                self.server_name = socket.getfqdn(host)
+                self.server_port = port
+                self.setup_environ()
+
+            def server_activate(self):
+                pass  # the socket is listening already
+
+        self.options['server_class'] = Server
+        WSGIRefServer.run(self, app)
+
+def open_listener(address, reuse_port=False):
+    """
+    Opens a socket for web requests
+
+    :param address: the host and port to listen to
+    :type address: ``tuple``
+
+    :param reuse_port: let other processes bind the same port
+    :type reuse_port: ``bool``
+
+    :return: a listening socket
+    :rtype: ``socket.socket``
+
+    """
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind(address)
+    listener.listen(128)
+    return listener
+
+def serve_workers(settings):
+    """
+    Serves web requests from several processes
+
+    :param settings: generic settings
+    :type settings: ``dict``
+
+    The number of processes is set with `workers:` in the `server:` section
+    of the configuration. Each worker binds its own socket with SO_REUSEPORT,
+    so that the kernel spreads connections over workers. Where this option
+    is not available, workers share a socket bound before they are forked.
+
+    Workers that stop are replaced, and all workers are stopped with the
+    server.
+    """
+
+    address = ('0.0.0.0', settings['server']['port'])
+
+    if hasattr(socket, 'SO_REUSEPORT'):
+        logging.info("- workers bind port {} with SO_REUSEPORT".format(address[1]))
+        listener = None
+    else:
+        logging.info("- workers share a socket on port {}".format(address[1]))
+        listener = open_listener(address)
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                run_worker(settings, listener or open_listener(address, reuse_port=True))
+            except Exception as feedback:
+                logging.error(str(feedback))
+                code = 1
+            finally:
+                os._exit(code)
+
+        return pid
+
+    children = set()
+    for index in range(int(settings['server']['workers'])):
+        children.add(spawn())
+
+    logging.info("- {} workers have been started".format(len(children)))
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        while True:
+            pid, status = os.wait()
+            if pid in children:
+                children.remove(pid)
+                logging.warning("- worker {} has stopped, restarting it".format(pid))
+                time.sleep(1)
+                children.add(spawn())
+
+    except (KeyboardInterrupt, SystemExit):
+        logging.info("Stopping workers")
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+def run_worker(settings, listener):
+    """
+    Serves web requests in a worker process
+
+    :param settings: generic settings
+    :type settings: ``dict``
+
+    :param listener: the socket to get requests from
+    :type listener: ``socket.socket``
+
+    Connections and threads of the parent process are not used in workers.
+    """
+
+    global spark_client, state_store
+
+    spark_client = None
+    state_store = None
+    twilio_clients.clear()
+    limiters.clear()
+    breakers.clear()
+
+    if settings['server'].get('queue_workers'):
+        start_pipeline(settings)
+
+    if settings['server'].get('watch', True):
+        watch_configuration(settings)
+
+    logging.info("Worker {} is ready for web requests".format(os.getpid()))
+    web.run(server=ListenerServer(*listener.getsockname()[:2], listener=listener),
+            debug=(logging.getLogger().getEffectiveLevel() == logging.DEBUG))
+
 #
 # launched from the command line
 #
@@ -1016,15 +3995,57 @@ if __name__ == "__main__":
     settings = configure()
     logging.debug('Settings: {}'.format(settings))
 
-    # pre-load all available buttons
+    # workers share the state of buttons
+    #
+    workers = int(settings['server'].get('workers', 1))
+    if workers > 1:
+        settings['server'].setdefault('state', 'sqlite')
+        if settings['server']['state'] == 'memory':
+            logging.warning("Workers will not share the state of buttons")
+
+    # pre-load all available buttons, or serve requests right away
+    #
+    if settings['server'].get('lazy_load') and workers < 2:
+        update_tokens(settings, {})
+
+        loader = threading.Thread(target=load_buttons,
+                                  args=(settings,),
+                                  kwargs={'preserve': True},
+                                  name='loader')
+        loader.daemon = True
+        loader.start()
+
+    else:
+        load_buttons(settings)
+        logging.debug('Tokens: {}'.format(settings['tokens']))
+
+    # serve requests from several processes
+    #
+    if workers > 1:
+        logging.info("Preparing workers for web requests")
+        serve_workers(settings)
+        sys.exit(0)
+
+    # execute pushes in the background if required
     #
-    load_buttons(settings)
-    logging.debug('Tokens: {}'.format(settings['tokens']))
+    if settings['server'].get('queue_workers'):
+        start_pipeline(settings)
+
+    # reload configuration files on change
+    #
+    if settings['server'].get('watch', True):
+        watch_configuration(settings)
 
     # wait for button pushes and other web requests
     #
-    logging.info("Preparing for web requests")
+    if cooperative:
+        logging.info("Preparing greenlets for web requests")
+        server = 'gevent'
+    else:
+        logging.info("Preparing for web requests")
+        server = os.environ.get('SERVER', "auto")
+
     web.run(host='0.0.0.0',
         port=settings['server']['port'],
         debug=(logging.getLogger().getEffectiveLevel() == logging.DEBUG),
-        server=os.environ.get('SERVER', "auto"))
+        server=server)
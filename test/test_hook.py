@@ -31,8 +31,23 @@ spark:
 
 """
 
+class FakeResponse(object):
+
+    def __init__(self, status_code=200, content=None, headers=None, links=None):
+        self.status_code = status_code
+        self.content = content if content is not None else {}
+        self.headers = headers if headers is not None else {}
+        self.links = links if links is not None else {}
+
+    def json(self):
+        return self.content
+
 class HookTests(unittest.TestCase):
 
+    def setUp(self):
+        import hook
+        hook.breakers.clear()  # failures of previous tests are forgotten
+
     def test_configure(self):
 
         print('***** Test configure ***')
@@ -52,6 +67,10 @@ class HookTests(unittest.TestCase):
 
         self.assertTrue(settings['server']['default'] == 'incident')
 
+        with mock.patch('sys.argv', ['hook.py', '--async', '8081']):
+            settings = configure('settings.yaml')
+            self.assertEqual(settings['server']['port'], 8081)
+
     def test_load_button(self):
 
         print('***** Test load button ***')
@@ -124,6 +143,322 @@ class HookTests(unittest.TestCase):
         self.assertTrue('request' in keys)
 
 
+    def test_load_buttons_concurrently(self):
+
+        print('***** Test load buttons concurrently ***')
+
+        import hook
+        from hook import configure, load_buttons, load_button
+
+        settings = configure('settings.yaml')
+
+        with mock.patch('hook.fan_out', side_effect=hook.fan_out) as fan_out:
+            buttons = load_buttons(settings)
+            self.assertEqual(fan_out.call_count, 1)
+            self.assertEqual(sorted(fan_out.call_args[0][1]), sorted(buttons.keys()))
+
+        # generic settings are shared, not copied in depth, and not modified
+        context = buttons['incident']
+        self.assertFalse(context['spark'] is settings['spark'])
+        self.assertEqual(settings['spark'].get('room'), None)
+        self.assertTrue(context['twilio']['customer_service_number'] is settings['twilio']['customer_service_number'])
+        self.assertFalse('tokens' in context)
+
+        # buttons loaded meanwhile are preserved on demand
+        context['count'] = 3
+        buttons = load_buttons(settings, preserve=True)
+        self.assertTrue(buttons['incident'] is context)
+        self.assertEqual(load_button(settings, 'incident')['count'], 3)
+
+        def fan_out(action, items, workers=8):
+            done = fan_out.original(action, items, workers)
+            hook.buttons.pop('request', None)
+            load_button(settings, 'request')['count'] = 2  # pushed while files are parsed
+            return done
+
+        fan_out.original = hook.fan_out
+        with mock.patch('hook.fan_out', side_effect=fan_out):
+            buttons = load_buttons(settings, preserve=True)
+        self.assertEqual(buttons['request']['count'], 2)
+        self.assertTrue(buttons['request'] is hook.buttons['request'])
+        buttons['request']['count'] = 0
+
+        buttons = load_buttons(settings)
+        self.assertFalse(buttons['incident'] is context)
+        self.assertEqual(load_button(settings, 'incident')['count'], 0)
+
+        # a broken file does not prevent other buttons from loading
+        with open(os.path.abspath(os.path.dirname(__file__))+'/../buttons/temporary.yaml', 'w') as handle:
+            handle.write('bt.tn: [ *unknown* ]')
+        buttons = load_buttons(settings)
+        os.remove(os.path.abspath(os.path.dirname(__file__))+'/../buttons/temporary.yaml')
+        self.assertFalse('temporary' in buttons)
+        self.assertTrue('incident' in buttons)
+
+    def test_snapshot(self):
+
+        print('***** Test snapshot ***')
+
+        import hook
+        from hook import configure, load_buttons, read_yaml
+
+        path = os.path.abspath(os.path.dirname(__file__))+'/.snapshot'
+
+        with mock.patch('hook.get_snapshot_path', return_value=path):
+
+            hook.snapshot = None
+            settings = configure('settings.yaml')
+            load_buttons(settings)
+            self.assertTrue(os.path.exists(path))
+
+            # next start does not parse files
+            hook.snapshot = None
+            with mock.patch('hook.yaml.load') as parse:
+                settings = configure('settings.yaml')
+                buttons = load_buttons(settings)
+                self.assertEqual(parse.call_count, 0)
+
+            self.assertTrue('incident' in buttons)
+            self.assertEqual(len(buttons['incident']['plan']), 5)
+
+            # content can be modified safely
+            content = read_yaml('settings.yaml')
+            content['server']['port'] = 1234
+            self.assertEqual(read_yaml('settings.yaml')['server']['port'], 8080)
+
+            # only changed files are parsed again
+            name = os.path.abspath(os.path.dirname(__file__))+'/../buttons/temporary.yaml'
+            with open(name, 'w') as handle:
+                handle.write(my_button)
+
+            hook.snapshot = None
+            with mock.patch('hook.yaml.load', side_effect=yaml.load) as parse:
+                settings = configure('settings.yaml')
+                buttons = load_buttons(settings)
+                self.assertEqual(parse.call_count, 1)
+
+            os.utime(name, (time.time()+10, time.time()+10))
+            with mock.patch('hook.yaml.load', side_effect=yaml.load) as parse:
+                self.assertEqual(read_yaml('buttons/temporary.yaml')['spark']['room'], 'another green button')
+                self.assertEqual(parse.call_count, 1)
+
+            os.remove(name)
+            load_buttons(settings)
+            self.assertFalse('buttons/temporary.yaml' in hook.snapshot)
+
+        os.remove(path)
+        hook.snapshot = None
+
+    def test_reload_configuration(self):
+
+        print('***** Test reload configuration ***')
+
+        import hook
+        from hook import configure, load_buttons, scan_configuration, reload_configuration
+
+        settings = configure('settings.yaml')
+        settings['server']['key'] = 'a_secret'
+        buttons = dict(load_buttons(settings))  # previous contexts
+
+        name = os.path.abspath(os.path.dirname(__file__))+'/../buttons/temporary.yaml'
+
+        # a new button is loaded, with its tokens
+        before = scan_configuration()
+        with open(name, 'w') as handle:
+            handle.write(my_button)
+        after = scan_configuration()
+
+        with mock.patch('hook.encode_token', side_effect=hook.encode_token) as encode_token:
+            settings = reload_configuration(settings, before, after)
+            self.assertEqual(encode_token.call_count, 4+1)
+
+        self.assertEqual(hook.buttons['temporary']['spark']['room'], 'another green button')
+        self.assertTrue('temporary-call' in settings['tokens'])
+        self.assertTrue(hook.buttons['incident'] is buttons['incident'])
+
+        # a changed button keeps its state
+        hook.buttons['temporary']['count'] = 2
+        hook.buttons['temporary']['time'] = 123
+        with open(name, 'w') as handle:
+            handle.write(my_button.replace('another green button', 'a new room'))
+        os.utime(name, (time.time()+10, time.time()+10))
+        before, after = after, scan_configuration()
+
+        with mock.patch('hook.encode_token', side_effect=hook.encode_token) as encode_token:
+            settings = reload_configuration(settings, before, after)
+            self.assertEqual(encode_token.call_count, 0)
+
+        self.assertEqual(hook.buttons['temporary']['spark']['room'], 'a new room')
+        self.assertEqual(hook.buttons['temporary']['count'], 2)
+        self.assertEqual(hook.buttons['temporary']['time'], 123)
+
+        # a removed button is forgotten, with its tokens
+        os.remove(name)
+        before, after = after, scan_configuration()
+        settings = reload_configuration(settings, before, after)
+
+        self.assertFalse('temporary' in hook.buttons)
+        self.assertFalse('temporary-call' in settings['tokens'])
+        self.assertTrue('incident-call' in settings['tokens'])
+
+        with open(os.path.abspath(os.path.dirname(__file__))+'/../.tokens', 'r') as handle:
+            self.assertEqual(yaml.load(handle), settings['tokens'])
+
+        # all buttons are rebuilt on change of generic settings
+        hook.buttons['incident']['count'] = 3
+        before = dict(after)
+        before['settings.yaml'] = (0, 0)
+        settings = reload_configuration(settings, before, after)
+
+        self.assertFalse(hook.buttons['incident'] is buttons['incident'])
+        self.assertEqual(hook.buttons['incident']['count'], 3)
+        self.assertTrue(hook.settings is settings)
+        self.assertEqual(settings['server'].get('key'), None)
+        self.assertEqual(settings['tokens']['incident'], 'incident')
+
+        # invalid settings are not used, and buttons are still reloaded
+        with open(name, 'w') as handle:
+            handle.write(my_button)
+        before = dict(after)
+        before['settings.yaml'] = (0, 0)
+        after = scan_configuration()
+
+        def read_yaml(path):
+            if path == 'settings.yaml':
+                raise yaml.YAMLError('invalid settings')
+            return read_yaml.original(path)
+
+        read_yaml.original = hook.read_yaml
+        with mock.patch('hook.read_yaml', side_effect=read_yaml):
+            self.assertTrue(reload_configuration(settings, before, after) is settings)
+
+        self.assertTrue('temporary' in hook.buttons)
+        os.remove(name)
+        settings = reload_configuration(settings, after, scan_configuration())
+
+        hook.buttons['incident']['count'] = 0
+
+    def test_concurrent_reloads(self):
+
+        print('***** Test concurrent reloads ***')
+
+        import threading
+        import hook
+        from hook import configure, load_button, scan_configuration, reload_configuration
+
+        settings = configure('settings.yaml')
+        hook.buttons.pop('request', None)
+        load_button(settings, 'request')['count'] = 0
+
+        after = scan_configuration()
+        before = dict(after)
+        before['buttons/request.yaml'] = (0, 0)
+
+        counted = []
+        running = [True]
+
+        def press():
+            while running[0]:
+                if hook.count_push(load_button(settings, 'request')) is not None:
+                    counted.append(1)
+
+        threads = [threading.Thread(target=press) for index in range(4)]
+        for thread in threads:
+            thread.start()
+
+        # no push is lost while the button is being reloaded
+        for index in range(50):
+            settings = reload_configuration(settings, before, after)
+
+        running[0] = False
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(len(counted) > 0)
+        self.assertEqual(load_button(settings, 'request')['count'], len(counted))
+
+        hook.buttons.pop('request', None)
+
+    def test_state_stores(self):
+
+        print('***** Test state stores ***')
+
+        import tempfile
+        from hook import MemoryState, SqliteState, RedisState
+
+        def check(first, second):
+
+            context = {'name': 'incident'}
+            first.load(context)
+            self.assertEqual(context['count'], 0)
+
+            self.assertEqual(first.push(context, reset=60, now=1000), 1)
+            self.assertEqual(first.push(context, reset=60, now=1010), 2)
+
+            # another process shares the same counter
+            other = {'name': 'incident'}
+            second.load(other)
+            self.assertEqual(other['count'], 2)
+            self.assertEqual(second.push(other, reset=60, now=1020), 3)
+
+            # the escalation restarts after some time
+            self.assertEqual(first.push(context, reset=60, now=2000), 1)
+            self.assertEqual(context['count'], 1)
+
+            # a push that has not been handled is cancelled
+            self.assertEqual(first.push(context, reset=60, now=2010), 2)
+            self.assertTrue(first.cancel(context, 2))
+            self.assertEqual((context['count'], context['time']), (1, 2000))
+            self.assertFalse(first.cancel(context, 2))
+            second.load(other)
+            self.assertEqual(other['count'], 1)
+
+            # but not once the button has been pushed again
+            self.assertEqual(first.push(context, reset=60, now=2020), 2)
+            self.assertEqual(second.push(other, reset=60, now=2030), 3)
+            self.assertFalse(first.cancel(context, 2))
+            second.load(other)
+            self.assertEqual(other['count'], 3)
+
+            first.clear(context)
+            second.load(other)
+            self.assertEqual(other['count'], 0)
+
+        store = MemoryState()
+        context = {'name': 'incident'}
+        store.load(context)
+        self.assertEqual(store.push(context, reset=60, now=1000), 1)
+        self.assertEqual(store.push(context, reset=60, now=1010), 2)
+        self.assertEqual(store.push(context, reset=60, now=2000), 1)
+        self.assertTrue(store.cancel(context, 1))
+        self.assertEqual((context['count'], context['time']), (2, 1010))
+        self.assertEqual(store.push(context, reset=60, now=1020), 3)
+
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            check(SqliteState(path), SqliteState(path))
+
+            # state survives restarts
+            context = {'name': 'incident'}
+            SqliteState(path).push(context)
+            SqliteState(path).load(context)
+            self.assertEqual(context['count'], 1)
+
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path+suffix):
+                    os.remove(path+suffix)
+
+        try:
+            import fakeredis
+        except ImportError:
+            return
+
+        server = fakeredis.FakeStrictRedis()
+        server.flushall()
+        check(RedisState(client=server), RedisState(client=server))
+
     def test_temporary_button(self):
 
         print('***** Test temporary button ***')
@@ -170,11 +505,672 @@ class HookTests(unittest.TestCase):
         context = load_button(settings, name='request')
         self.assertTrue(isinstance(context, dict))
 
+        context['spark']['retry_deadline'] = 0.1  # no network in tests, fail fast
+
         try:
             get_room(context)
         except ConnectionError:
             pass
 
+        del context['spark']['retry_deadline']
+
+    def test_room_cache(self):
+
+        print('***** Test room cache ***')
+
+        import hook
+        from hook import configure, load_button, get_room, delete_room
+
+        settings = configure('settings.yaml')
+        context = load_button(settings, name='request')
+
+        calls = []
+
+        def fake_request(method, url, **kwargs):
+            calls.append((method.upper(), url))
+
+            if url.endswith('/v1/rooms'):
+                if method.upper() == 'POST':
+                    return FakeResponse(content={'id': '*new*'})
+                return FakeResponse(content={'items': [
+                    {'id': '*other*', 'title': 'some other room'},
+                    {'id': '*id*', 'title': context['spark']['room']}]})
+
+            if url.endswith('/v1/rooms/*id*'):
+                if method.upper() == 'DELETE':
+                    return FakeResponse(status_code=204)
+                return FakeResponse(content={'id': '*id*', 'title': context['spark']['room']})
+
+            return FakeResponse(status_code=404)
+
+        with mock.patch('hook.get_rooms_path', return_value=os.path.abspath(os.path.dirname(__file__))+'/.rooms'), \
+             mock.patch('hook.add_audience'), \
+             mock.patch('requests.Session.request', side_effect=fake_request):
+
+            hook.rooms = None
+
+            # cache miss, rooms are listed
+            self.assertEqual(get_room(context), '*id*')
+            self.assertEqual(calls, [('GET', 'https://api.ciscospark.com/v1/rooms')])
+
+            # cache hit, room is only checked
+            calls[:] = []
+            self.assertEqual(get_room(context), '*id*')
+            self.assertEqual(calls, [('GET', 'https://api.ciscospark.com/v1/rooms/*id*')])
+
+            # the cache survives a restart
+            hook.rooms = None
+            calls[:] = []
+            self.assertEqual(get_room(context), '*id*')
+            self.assertEqual(calls, [('GET', 'https://api.ciscospark.com/v1/rooms/*id*')])
+
+            # room has disappeared
+            hook.rooms['request'] = '*lost*'
+            calls[:] = []
+            self.assertEqual(get_room(context), '*id*')
+            self.assertEqual(calls, [('GET', 'https://api.ciscospark.com/v1/rooms/*lost*'),
+                                     ('GET', 'https://api.ciscospark.com/v1/rooms')])
+
+            # deletion invalidates the cache
+            delete_room(context)
+            self.assertTrue('request' not in hook.rooms)
+
+            os.remove(os.path.abspath(os.path.dirname(__file__))+'/.rooms')
+            hook.rooms = None
+
+    def test_concurrent_pushes(self):
+
+        print('***** Test concurrent pushes ***')
+
+        import threading
+        import hook
+        from hook import configure, load_button, web_press
+
+        settings = configure('settings.yaml')
+        hook.settings = settings
+        hook.buttons.pop('request', None)
+
+        created = []
+
+        def fake_request(method, url, **kwargs):
+            time.sleep(0.01)
+
+            if url.endswith('/v1/rooms'):
+                if method.upper() == 'POST':
+                    created.append(url)
+                    return FakeResponse(content={'id': '*new*'})
+                return FakeResponse(content={'items': []})
+
+            if url.endswith('/v1/rooms/*new*'):
+                return FakeResponse(content={'id': '*new*', 'title': hook.buttons['request']['spark']['room']})
+
+            return FakeResponse(status_code=404)
+
+        outcomes = []
+
+        def press():
+            for index in range(10):
+                outcomes.append(web_press('request'))
+
+        with mock.patch('hook.get_rooms_path', return_value=os.path.abspath(os.path.dirname(__file__))+'/.rooms'), \
+             mock.patch('hook.add_audience'), \
+             mock.patch('hook.execute_push'), \
+             mock.patch('hook.save_tokens'), \
+             mock.patch('requests.Session.request', side_effect=fake_request):
+
+            hook.rooms = None
+
+            threads = [threading.Thread(target=press) for index in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # one room, and no push has been lost
+            self.assertEqual(len(created), 1)
+            self.assertEqual(sorted(outcomes), sorted(["OK {}\n".format(count) for count in range(1, 201)]))
+            self.assertEqual(load_button(settings, 'request')['count'], 200)
+
+            os.remove(os.path.abspath(os.path.dirname(__file__))+'/.rooms')
+            hook.rooms = None
+
+        # pushes are counted while a room is being created
+        with hook.lock_room('request'):
+            counter = threading.Thread(target=hook.count_push, args=(load_button(settings, 'request'),))
+            counter.start()
+            counter.join(1.0)
+            self.assertFalse(counter.is_alive())
+
+        hook.buttons.pop('request', None)
+
+    def test_workers(self):
+
+        print('***** Test workers ***')
+
+        import socket
+        import threading
+        import urllib2
+        import hook
+        from hook import configure, load_button, open_listener, ListenerServer, lock_rooms, web
+
+        # workers share the same socket
+        listener = open_listener(('127.0.0.1', 0))
+        host, port = listener.getsockname()
+
+        servers = []
+        for index in range(2):
+            server = ListenerServer(host, port, listener=listener, quiet=True)
+            thread = threading.Thread(target=server.run, args=(web,))
+            thread.daemon = True
+            thread.start()
+            servers.append(server)
+
+        for index in range(4):
+            self.assertEqual(urllib2.urlopen('http://{}:{}/ping'.format(host, port), timeout=5).read(), 'pong')
+
+        for server in servers:
+            while not hasattr(server, 'srv'):
+                time.sleep(0.01)
+            server.srv.shutdown()
+        listener.close()
+
+        # workers can also bind the same port
+        if hasattr(socket, 'SO_REUSEPORT'):
+            first = open_listener(('127.0.0.1', 0), reuse_port=True)
+            second = open_listener(first.getsockname(), reuse_port=True)
+            first.close()
+            second.close()
+
+        # rooms created by other workers are found
+        settings = configure('settings.yaml')
+        context = load_button(settings, name='request')
+        context['server']['workers'] = 2
+
+        path = os.path.abspath(os.path.dirname(__file__))+'/.rooms'
+        with open(path, 'w') as handle:
+            handle.write("request: '*id*'\n")
+
+        with mock.patch('hook.get_rooms_path', return_value=path):
+            hook.rooms = {}
+            with lock_rooms(context):
+                self.assertEqual(hook.rooms.get('request'), '*id*')
+
+        context['server']['workers'] = 1
+        os.remove(path)
+        os.remove(path+'.lock')
+        hook.rooms = None
+
+    def test_debounce(self):
+
+        print('***** Test debounce ***')
+
+        import hook
+        from hook import configure, load_button, count_push, handle_button, get_push_stats
+
+        settings = configure('settings.yaml')
+        context = load_button(settings, name='request')
+        context['count'] = 0
+        context.pop('time', None)
+        context['spark']['debounce'] = 5
+
+        coalesced = get_push_stats()['coalesced']
+
+        self.assertEqual(count_push(context), 1)
+        self.assertEqual(count_push(context), None)
+        self.assertEqual(context['count'], 1)
+
+        # duplicates are dropped before any call to Cisco Spark
+        with mock.patch('hook.get_room') as get_room, \
+             mock.patch('hook.execute_push') as execute_push:
+            self.assertEqual(handle_button(context), "OK 1\n")
+            self.assertFalse(get_room.called)
+            self.assertFalse(execute_push.called)
+
+        stats = get_push_stats()
+        self.assertEqual(stats['coalesced'], coalesced+2)
+        self.assertTrue(stats['coalesced_buttons']['request'] >= 2)
+
+        # next push after the window is a new step
+        context['time'] -= 10
+        self.assertEqual(count_push(context), 2)
+
+        # a push is cancelled if the room cannot be found, and bt.tn can try again
+        context['time'] -= 10
+        counted = get_push_stats()['counted']
+        with mock.patch('hook.get_room', side_effect=hook.CircuitOpenError('spark')), \
+             mock.patch('hook.execute_push') as execute_push:
+            with self.assertRaises(hook.CircuitOpenError):
+                handle_button(context)
+            self.assertFalse(execute_push.called)
+
+        self.assertEqual(context['count'], 2)
+        self.assertEqual(get_push_stats()['counted'], counted)
+        self.assertEqual(count_push(context), 3)
+
+        del context['spark']['debounce']
+        context['count'] = 0
+
+    def test_resilience(self):
+
+        print('***** Test resilience ***')
+
+        from requests import ConnectionError
+        from twilio import TwilioRestException
+        import hook
+        from hook import configure, load_button, post_update, call_resilient, \
+            check_spark, check_spark_unprocessed, check_twilio, get_retry_after, \
+            CircuitOpenError, AttachmentStream
+
+        settings = {'retry_delay': 0.01, 'retry_deadline': 0.5, 'circuit_failures': 3}
+
+        # transient failures are retried
+        outcomes = [FakeResponse(status_code=429, headers={'Retry-After': '0'}), FakeResponse()]
+        response = call_resilient(settings, 'here', lambda: outcomes.pop(0), check_spark)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(outcomes, [])
+
+        # other failures are not
+        outcomes = [FakeResponse(status_code=404), FakeResponse()]
+        response = call_resilient(settings, 'here', lambda: outcomes.pop(0), check_spark)
+        self.assertEqual(response.status_code, 404)
+
+        # retries stop at the deadline, and then the circuit is opened
+        action = mock.Mock(return_value=FakeResponse(status_code=503))
+        started = time.time()
+        response = call_resilient(settings, 'there', action, check_spark)
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(time.time() - started < 1.0)
+
+        action.reset_mock()
+        with self.assertRaises(ConnectionError):
+            call_resilient(settings, 'there', action, check_spark)
+        with self.assertRaises(CircuitOpenError):
+            call_resilient(settings, 'there', action, check_spark)
+        self.assertFalse(action.called)
+
+        # failures that are not retried also open the circuit
+        action = mock.Mock(return_value=FakeResponse(status_code=500))
+        for index in range(3):
+            self.assertEqual(call_resilient(settings, 'messages', action, check_spark_unprocessed).status_code, 500)
+        self.assertEqual(action.call_count, 3)
+        with self.assertRaises(CircuitOpenError):
+            call_resilient(settings, 'messages', action, check_spark_unprocessed)
+
+        def fail():
+            raise TwilioRestException(500, 'http://localhost/', 'down')
+
+        for index in range(3):
+            with self.assertRaises(TwilioRestException):
+                call_resilient(settings, 'calls', fail, check_twilio)
+        with self.assertRaises(CircuitOpenError):
+            call_resilient(settings, 'calls', fail, check_twilio)
+
+        self.assertEqual(get_retry_after({'Retry-After': '3'}), 3)
+        self.assertTrue(get_retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}) == 0)
+        self.assertEqual(check_twilio(None, TwilioRestException(429, 'http://localhost/', 'busy')), 0)
+        self.assertEqual(check_twilio(None, TwilioRestException(400, 'http://localhost/', 'bad')), None)
+
+        # files are uploaded again on retry, and new messages are not repeated on errors
+        context = load_button(configure('settings.yaml'), name='request')
+        context['spark'].update(settings)
+        context['spark']['id'] = '*id*'
+
+        bodies = []
+
+        def fake_request(method, url, data=None, **kwargs):
+            bodies.append(data.read())
+            if len(bodies) == 1:
+                return FakeResponse(status_code=503)
+            return FakeResponse(status_code=500)
+
+        with mock.patch('requests.Session.request', side_effect=fake_request):
+            with self.assertRaises(Exception):
+                post_update(context, {'files': ('note', AttachmentStream(b'some content'), 'text/plain')})
+
+        self.assertEqual(len(bodies), 2)
+        self.assertTrue(b'some content' in bodies[1])
+
+        for key in settings.keys():
+            del context['spark'][key]
+
+    def test_rate_limiter(self):
+
+        print('***** Test rate limiter ***')
+
+        import threading
+        import hook
+        from hook import configure, load_button, post_update, add_person, RateLimiter, RateLimitError
+
+        limiter = RateLimiter(rate=50, burst=1)
+        started = time.time()
+        for index in range(6):
+            limiter.acquire()
+        self.assertTrue(time.time() - started >= 0.09)
+
+        # updates of rooms pass before bulk additions of people
+        limiter = RateLimiter(rate=10, burst=1)
+        limiter.acquire()
+
+        order = []
+
+        def call(priority):
+            limiter.acquire(priority)
+            order.append(priority)
+
+        bulk = threading.Thread(target=call, args=(2,))
+        bulk.start()
+        time.sleep(0.02)
+        update = threading.Thread(target=call, args=(0,))
+        update.start()
+        bulk.join()
+        update.join()
+        self.assertEqual(order, [0, 2])
+
+        with self.assertRaises(RateLimitError):
+            RateLimiter(queue=0).acquire()
+
+        # limits are set in the spark: section
+        context = load_button(configure('settings.yaml'), name='request')
+        context['spark']['rate'] = 5
+        context['spark']['id'] = '*id*'
+
+        with mock.patch('requests.Session.request', return_value=FakeResponse()), \
+             mock.patch('hook.RateLimiter.acquire') as acquire:
+
+            post_update(context, 'hello')
+            acquire.assert_called_with(0)
+
+            add_person(context, 'a.b@c.com')
+            acquire.assert_called_with(2)
+
+        # an overflow of the queue is neither retried, nor a failure of Cisco Spark
+        context['spark']['rate_queue'] = 0
+        with mock.patch('requests.Session.request', return_value=FakeResponse()) as request:
+            for index in range(8):
+                with self.assertRaises(RateLimitError):
+                    hook.get_spark(context).get(url='https://api.ciscospark.com/v1/rooms')
+            self.assertFalse(request.called)
+
+        self.assertEqual(hook.breakers['api.ciscospark.com/v1/rooms'].count, 0)
+
+        del context['spark']['rate']
+        del context['spark']['rate_queue']
+
+    def test_batch_updates(self):
+
+        print('***** Test batch updates ***')
+
+        import hook
+        from hook import configure, load_button, execute_push, post_update, AttachmentStream
+
+        context = load_button(configure('settings.yaml'), name='request')
+        context['spark']['id'] = '*id*'
+
+        posts = []
+
+        def fake_request(method, url, data=None, **kwargs):
+            posts.append(data if isinstance(data, dict) else data.read())
+            return FakeResponse()
+
+        def fake_sms(context, details):
+            post_update(context, {'markdown': "SMS 'hello' has been sent to '+1'"})
+
+        def fake_call(context, details):
+            post_update(context, {'markdown': "Calling '+1'"})
+
+        with mock.patch('requests.Session.request', side_effect=fake_request), \
+             mock.patch('hook.send_sms', side_effect=fake_sms), \
+             mock.patch('hook.phone_call', side_effect=fake_call):
+
+            # one message for the step and for reports on SMS and calls
+            with mock.patch('hook.get_push_details',
+                            return_value=({'text': 'hello\n'}, {'sms': '*sms*', 'call': '*call*'})):
+                execute_push(context, 1)
+
+            self.assertEqual(posts, [{'roomId': '*id*',
+                                      'markdown': "hello\n\nSMS 'hello' has been sent to '+1'\n\nCalling '+1'"}])
+
+            # files are uploaded separately
+            posts[:] = []
+            update = {'text': 'a file\n', 'files': ('note', AttachmentStream(b'some content'), 'text/plain')}
+            with mock.patch('hook.get_push_details', return_value=(update, {'sms': '*sms*'})):
+                execute_push(context, 1)
+
+            self.assertEqual(len(posts), 2)
+            self.assertTrue(b'some content' in posts[0])
+            self.assertEqual(posts[1]['markdown'], "SMS 'hello' has been sent to '+1'")
+
+            # updates are posted right away out of pushes
+            posts[:] = []
+            post_update(context, 'hello')
+            self.assertEqual(posts, [{'roomId': '*id*', 'text': 'hello'}])
+
+    def test_cached_twiml(self):
+
+        print('***** Test cached twiml ***')
+
+        import hook
+        from hook import configure, load_button, build_button, read_button, web_inbound_call
+
+        settings = configure('settings.yaml')
+        hook.settings = settings
+        context = load_button(settings, name='request')
+
+        self.assertEqual(len(context['twiml']['steps']), len(context['plan']))
+
+        with mock.patch('hook.get_push_details') as get_push_details, \
+             mock.patch('hook.get_attachment') as get_attachment, \
+             mock.patch('hook.read_yaml') as read_yaml:
+
+            for count, step in enumerate(context['plan'], 1):
+                context['count'] = count
+                answer = web_inbound_call('request')
+                if step.call is not None and step.call.say is not None:
+                    self.assertTrue(step.call.say in answer)
+                else:
+                    self.assertTrue("What's up Doc?" in answer)
+                self.assertTrue(answer is context['twiml']['steps'][count-1])
+
+            context['count'] = len(context['plan'])+1
+            self.assertTrue("What's up Doc?" in web_inbound_call('request'))
+
+            context['count'] = 0  # e.g., after the room has been deleted
+            self.assertTrue(web_inbound_call('request') is context['twiml']['default'])
+
+            self.assertFalse(get_push_details.called)
+            self.assertFalse(get_attachment.called)
+            self.assertFalse(read_yaml.called)
+
+        context['count'] = 0
+
+        # answers change with the configuration of the button
+        additions = read_button('request')
+        for item in additions['bt.tn']:
+            if 'call' in item:
+                item['call'] = [{'say': 'Something else'}] + [line for line in item['call'] if 'say' not in line]
+        fresh = build_button(settings, 'request', additions)
+        self.assertTrue(any('Something else' in answer for answer in fresh['twiml']['steps']))
+
+    def test_index_cache(self):
+
+        print('***** Test index cache ***')
+
+        import email.utils
+        import json
+        from wsgiref.util import setup_testing_defaults
+        import hook
+        from hook import configure, load_buttons, web
+
+        settings = configure('settings.yaml')
+        hook.settings = settings
+        load_buttons(settings)
+
+        def get(path, **headers):
+            environ = {'PATH_INFO': path}
+            setup_testing_defaults(environ)
+            for key, value in headers.items():
+                environ['HTTP_'+key.upper().replace('-', '_')] = value
+            outcome = {}
+
+            def start_response(status, response_headers, exc_info=None):
+                outcome['status'] = int(status.split()[0])
+                outcome['headers'] = dict((key.lower(), value) for key, value in response_headers)
+
+            outcome['body'] = b''.join(web(environ, start_response))
+            return outcome
+
+        here = os.getcwd()
+        os.chdir(os.path.abspath(os.path.dirname(__file__))+'/..')  # for templates
+        try:
+            first = get('/index')
+        finally:
+            os.chdir(here)
+        self.assertEqual(first['status'], 200)
+        self.assertTrue('incident' in first['body'])
+        etag = first['headers']['etag']
+
+        # the page is rendered only once
+        with mock.patch('hook.template') as template:
+            self.assertEqual(get('/index')['body'], first['body'])
+            self.assertFalse(template.called)
+
+        self.assertEqual(get('/index', if_none_match=etag)['status'], 304)
+        self.assertEqual(get('/index', if_none_match='"other"')['status'], 200)
+
+        # the time of last change is given once its second is over
+        with mock.patch('time.time', return_value=time.time()+2):
+            modified = get('/index')['headers']['last-modified']
+            self.assertEqual(get('/index', if_modified_since=modified)['status'], 304)
+
+        # the page is rendered again on change of buttons
+        hook.touch_index()
+        with mock.patch('hook.template', return_value='new page') as template:
+            self.assertEqual(get('/index', if_none_match=etag)['body'], 'new page')
+            self.assertTrue(template.called)
+
+        # a change within the current second is not hidden
+        with mock.patch('time.time', return_value=time.time()+4), \
+             mock.patch('hook.template', return_value='new page'):
+            hook.touch_index()
+            page = get('/index')
+            self.assertFalse('last-modified' in page['headers'])
+            since = email.utils.formatdate(time.time(), usegmt=True)
+            self.assertEqual(get('/index', if_modified_since=since)['status'], 200)
+            self.assertEqual(get('/index', if_none_match=page['headers']['etag'])['status'], 304)
+
+        # index for monitoring tools
+        index = get('/index.json')
+        self.assertEqual(index['headers']['content-type'], 'application/json')
+        labels = [item['label'] for item in json.loads(index['body'])['buttons']]
+        self.assertTrue('incident' in labels)
+        self.assertEqual(get('/index.json', if_none_match=index['headers']['etag'])['status'], 304)
+
+        hook.touch_index()
+
+    def test_list_rooms(self):
+
+        print('***** Test list rooms ***')
+
+        import hook
+        from hook import configure, load_button, list_rooms, get_room
+
+        settings = configure('settings.yaml')
+        context = load_button(settings, name='request')
+
+        pages = {
+            'https://api.ciscospark.com/v1/rooms': FakeResponse(
+                content={'items': [{'id': '*1*', 'title': 'first room'},
+                                   {'id': '*2*', 'title': 'second room'}]},
+                links={'next': {'url': 'https://api.ciscospark.com/v1/rooms?cursor=2'}}),
+            'https://api.ciscospark.com/v1/rooms?cursor=2': FakeResponse(
+                content={'items': [{'id': '*3*', 'title': context['spark']['room']}]}),
+            }
+
+        calls = []
+
+        def fake_request(method, url, **kwargs):
+            calls.append(url)
+            return pages[url]
+
+        with mock.patch('requests.Session.request', side_effect=fake_request), \
+             mock.patch('hook.get_cached_room', return_value=None), \
+             mock.patch('hook.remember_room'):
+
+            # all pages are listed
+            self.assertEqual([item['id'] for item in list_rooms(context)],
+                             ['*1*', '*2*', '*3*'])
+            self.assertEqual(len(calls), 2)
+
+            # next page is fetched only when needed
+            calls[:] = []
+            rooms = list_rooms(context)
+            self.assertEqual(next(rooms)['id'], '*1*')
+            self.assertEqual(next(rooms)['id'], '*2*')
+            self.assertEqual(len(calls), 1)
+
+            # room is found on second page
+            calls[:] = []
+            self.assertEqual(get_room(context), '*3*')
+            self.assertEqual(len(calls), 2)
+
+    def test_spark_client(self):
+
+        print('***** Test spark client ***')
+
+        from hook import configure, load_button, get_spark
+
+        settings = configure('settings.yaml')
+        context = load_button(settings, name='request')
+
+        client = get_spark(context)
+        self.assertTrue(get_spark(context) is client)
+        self.assertEqual(client.session.get_adapter('https://api.ciscospark.com')._pool_maxsize, 10)
+
+        with mock.patch('requests.Session.request', return_value=FakeResponse()) as request:
+            client.get(url='https://api.ciscospark.com/v1/rooms')
+            self.assertEqual(request.call_args[1]['timeout'], (5.0, 30.0))
+
+        context = {'spark': {'pool_size': 3, 'timeout': 7}}
+        client = get_spark(context)
+        self.assertTrue(get_spark(context) is client)
+        self.assertEqual(client.session.get_adapter('https://api.ciscospark.com')._pool_maxsize, 3)
+        self.assertEqual(client.timeout, (5.0, 7.0))
+
+    def test_add_audience(self):
+
+        print('***** Test add audience ***')
+
+        from hook import configure, load_button, add_audience
+
+        settings = configure('settings.yaml')
+        context = load_button(settings, name='request')
+        context['spark']['id'] = '*id*'
+
+        people = []
+
+        def fake_request(method, url, data=None, **kwargs):
+            people.append((data['personEmail'], data['isModerator']))
+            if data['personEmail'] == 'laurent.mars@company.com':
+                return FakeResponse(status_code=409)
+            if data['personEmail'] == 'expert1@apache.org':
+                return FakeResponse(status_code=400)
+            return FakeResponse()
+
+        with mock.patch('requests.Session.request', side_effect=fake_request), \
+             mock.patch('hook.post_update') as post_update:
+
+            add_audience(context)
+
+        self.assertEqual(sorted(people), [('bernard.paques@dimensiondata.com', 'true'),
+                                          ('expert1@apache.org', 'false'),
+                                          ('laurent.mars@company.com', 'false')])
+
+        self.assertEqual(post_update.call_count, 1)
+        self.assertEqual(post_update.call_args[0][1]['markdown'].split('\n\n'),
+            ["Welcome to 'bernard.paques@dimensiondata.com'",
+             "Already in the room: 'laurent.mars@company.com'",
+             "Error: Unable to add 'expert1@apache.org' - Received error code 400"])
+
     @mock.patch('hook.send_sms', return_value='pumpkins')
     @mock.patch('hook.phone_call', return_value='pumpkins')
     @vcr.use_cassette('fixtures/test_incident.yaml')
@@ -187,6 +1183,8 @@ class HookTests(unittest.TestCase):
         context = load_button(settings, name='incident')
         self.assertTrue(isinstance(context, dict))
 
+        context['spark']['retry_deadline'] = 0.1  # no network in tests, fail fast
+
         self.assertEqual(context['count'], 0)
 
         try:
@@ -212,6 +1210,7 @@ class HookTests(unittest.TestCase):
             pass
 
         context['count'] = 0
+        del context['spark']['retry_deadline']
 
     @mock.patch('hook.send_sms', return_value='pumpkins')
     @mock.patch('hook.phone_call', return_value='pumpkins')
@@ -225,6 +1224,8 @@ class HookTests(unittest.TestCase):
         context = load_button(settings, name='request')
         self.assertTrue(isinstance(context, dict))
 
+        context['spark']['retry_deadline'] = 0.1  # no network in tests, fail fast
+
         self.assertEqual(context['count'], 0)
 
         try:
@@ -242,6 +1243,7 @@ class HookTests(unittest.TestCase):
             pass
 
         context['count'] = 0
+        del context['spark']['retry_deadline']
 
     @mock.patch('hook.send_sms', return_value='pumpkins')
     @mock.patch('hook.phone_call', return_value='pumpkins')
@@ -256,6 +1258,8 @@ class HookTests(unittest.TestCase):
         context = load_button(settings, name='incident')
         self.assertTrue(isinstance(context, dict))
 
+        context['spark']['retry_deadline'] = 0.1  # no network in tests, fail fast
+
         self.assertEqual(context['count'], 0)
 
         try:
@@ -285,6 +1289,309 @@ class HookTests(unittest.TestCase):
             pass
 
         context['count'] = 0
+        del context['spark']['retry_deadline']
+
+    @mock.patch('hook.get_room', return_value='*id*')
+    def test_queue_push(self, get_room_patch):
+
+        print('***** Test queue push ***')
+
+        import hook
+        from hook import configure, load_button, start_pipeline, queue_push, get_pipeline_stats
+
+        settings = configure('settings.yaml')
+        settings['server']['queue_workers'] = 2
+        start_pipeline(settings)
+
+        context = load_button(settings, name='request')
+        context['count'] = 0
+
+        executed = []
+
+        def fake_execute(context, count):
+            executed.append(count)
+            if count == 3:
+                raise Exception('pumpkins')
+
+        with mock.patch('hook.execute_push', side_effect=fake_execute):
+
+            self.assertEqual(queue_push(context), "OK 1\n")
+            self.assertEqual(queue_push(context), "OK 2\n")
+            self.assertEqual(queue_push(context), "OK 3\n")
+
+            hook.jobs.join()
+
+        self.assertEqual(sorted(executed), [1, 2, 3])
+
+        stats = get_pipeline_stats()
+        self.assertEqual(stats['workers'], 2)
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['processed'], 3)
+        self.assertEqual(stats['failed'], 1)
+        self.assertTrue(stats['max_latency'] >= stats['latency'] >= 0.0)
+
+        # a push that cannot be queued is not counted
+        with mock.patch.object(hook.slots, 'acquire', return_value=False):
+            with self.assertRaises(hook.Queue.Full):
+                queue_push(context)
+        self.assertEqual(context['count'], 3)
+
+        with mock.patch.object(hook.jobs, 'put_nowait', side_effect=hook.Queue.Full):
+            with self.assertRaises(hook.Queue.Full):
+                queue_push(context)
+        self.assertEqual(context['count'], 3)
+
+        context['count'] = 0
+
+    def test_send_sms(self):
+
+        print('***** Test send sms ***')
+
+        from twilio import TwilioRestException
+        from hook import configure, load_button, send_sms, phone_call
+
+        settings = configure('settings.yaml')
+        context = load_button(settings, name='request')
+        context['server']['url'] = 'http://localhost/'
+
+        created = []
+
+        def fake_create(to=None, **kwargs):
+            created.append(to)
+            if to == '+2':
+                raise TwilioRestException(500, 'http://localhost/', 'pumpkins')
+            if to == '+5':
+                raise ValueError('unexpected')
+            time.sleep(0.2)
+
+        import hook
+        hook.twilio_clients.clear()
+
+        with mock.patch('hook.TwilioRestClient') as client, \
+             mock.patch('hook.post_update') as post_update:
+
+            client.return_value.messages.create.side_effect = fake_create
+            client.return_value.calls.create.side_effect = fake_create
+
+            numbers = [{'number': '+{}'.format(index)} for index in range(1, 11)]
+
+            started = time.time()
+            send_sms(context, [{'message': 'hello world'}] + numbers)
+            self.assertTrue(time.time() - started < 1.0)
+
+            self.assertEqual(len(created), 10)
+            self.assertEqual(post_update.call_count, 1)
+            markdown = post_update.call_args[0][1]['markdown']
+            self.assertTrue(markdown.startswith("SMS 'hello world' has been sent to '+1, +3, +4,"))
+            self.assertTrue("for '+2'" in markdown)
+            self.assertTrue("Unable to use Twilio API for '+5'" in markdown)
+
+            post_update.reset_mock()
+            created[:] = []
+            phone_call(context, numbers)
+
+            self.assertEqual(len(created), 10)
+            self.assertEqual(post_update.call_count, 1)
+            markdown = post_update.call_args[0][1]['markdown']
+            self.assertTrue(markdown.startswith("Calling '+1, +3, +4,"))
+            self.assertTrue("for '+2'" in markdown)
+            self.assertTrue("Unable to use Twilio API for '+5'" in markdown)
+
+        context['server']['url'] = None
+        hook.twilio_clients.clear()
+
+    def test_twilio_clients(self):
+
+        print('***** Test twilio clients ***')
+
+        import hook
+        from hook import get_twilio
+
+        hook.twilio_clients.clear()
+
+        def context(account, token):
+            return {'twilio': {'TWILIO_ACCOUNT_SID': account,
+                               'TWILIO_AUTH_TOKEN': token,
+                               'clients': 2}}
+
+        with mock.patch('hook.TwilioRestClient', side_effect=lambda *args, **kwargs: object()) as client:
+
+            first = get_twilio(context('AC1', 'token'))
+            self.assertTrue(get_twilio(context('AC1', 'token')) is first)
+            self.assertEqual(client.call_count, 1)
+
+            # a new token replaces the former client of the account
+            second = get_twilio(context('AC1', 'new_token'))
+            self.assertFalse(second is first)
+            self.assertEqual(list(hook.twilio_clients.keys()), [('AC1', 'new_token')])
+
+            # least recently used client is evicted
+            get_twilio(context('AC2', 'token'))
+            self.assertTrue(get_twilio(context('AC1', 'new_token')) is second)
+            get_twilio(context('AC3', 'token'))
+            self.assertEqual(list(hook.twilio_clients.keys()),
+                             [('AC1', 'new_token'), ('AC3', 'token')])
+
+        hook.twilio_clients.clear()
+
+    def test_compile_plan(self):
+
+        print('***** Test compile plan ***')
+
+        from hook import configure, load_button, compile_plan, Sms, Call
+
+        settings = configure('settings.yaml')
+
+        context = load_button(settings, name='incident')
+        plan = context['plan']
+        self.assertEqual(len(plan), 5)
+
+        self.assertEqual(plan[0].file, 'files/dashboard.png')
+        self.assertEqual(plan[0].type, 'image/png')
+        self.assertEqual(plan[0].sms, None)
+
+        self.assertTrue(isinstance(plan[1].sms, Sms))
+        self.assertEqual(plan[1].sms.message, 'Check Cisco Spark')
+        self.assertEqual(plan[1].sms.numbers, ('+352691496401',))
+        self.assertEqual(plan[1].sms.from_number, settings['twilio']['customer_service_number'])
+
+        self.assertTrue(isinstance(plan[2].call, Call))
+        self.assertEqual(plan[2].call.url, None)
+        self.assertEqual(plan[2].call.say, 'Hello, please check Cisco Spark. There is an on-going escalation')
+
+        with self.assertRaises(AttributeError):
+            plan[0].file = 'files/spark.png'
+
+        context = {'twilio': {'customer_service_number': '+123'}}
+
+        context['bt.tn'] = ['hello']
+        with self.assertRaises(ValueError):
+            compile_plan(context)
+
+        context['bt.tn'] = [{'file': 'files/*unknown*.png'}]
+        with self.assertRaises(ValueError):
+            compile_plan(context)
+
+        context['bt.tn'] = [{'sms': [{'message': 'hello world'}]}]
+        with self.assertRaises(ValueError):
+            compile_plan(context)
+
+        context['bt.tn'] = [{'sms': [{'message': 'hi'}, {'number': '+456'}]}]
+        with self.assertRaises(ValueError):
+            compile_plan(context)
+
+        context['bt.tn'] = [{'call': [{'number': '+456', 'say': 'hello'}]}]
+        with self.assertRaises(ValueError):
+            compile_plan(context)
+
+        context['bt.tn'] = [{'call': ['+456']}]
+        with self.assertRaises(ValueError):
+            compile_plan(context)
+
+    def test_attachments(self):
+
+        print('***** Test attachments ***')
+
+        from requests_toolbelt import MultipartEncoder
+        from hook import AttachmentStore
+
+        here = os.path.abspath(os.path.dirname(__file__))
+        small = here+'/small.bin'
+        large = here+'/large.bin'
+
+        with open(small, 'wb') as handle:
+            handle.write(b'0123456789')
+        with open(large, 'wb') as handle:
+            handle.write(b'x' * 1000)
+
+        store = AttachmentStore(capacity=1005)
+
+        attachment = store.get(small)
+        self.assertTrue(store.get(small) is attachment)
+
+        stream = attachment.open()
+        self.assertEqual(len(stream), 10)
+        self.assertEqual(stream.read(4), b'0123')
+        self.assertEqual(len(stream), 6)
+        self.assertEqual(stream.read(), b'456789')
+        self.assertEqual(stream.read(), b'')
+
+        # streams are independent
+        self.assertEqual(attachment.open().read(2), b'01')
+
+        # streams are accepted for multipart uploads
+        payload = MultipartEncoder(fields={'files': ('small', attachment.open(), 'text/plain')})
+        self.assertTrue(b'0123456789' in payload.to_string())
+
+        # capacity is exceeded, least recently used is dropped
+        store.get(large)
+        self.assertEqual(list(store.attachments.keys()), [large])
+        self.assertEqual(store.size, 1000)
+
+        # content is reloaded on change
+        attachment = store.get(small)
+        time.sleep(0.01)
+        with open(small, 'wb') as handle:
+            handle.write(b'abc')
+        os.utime(small, (time.time()+10, time.time()+10))
+        self.assertFalse(store.get(small) is attachment)
+        self.assertEqual(store.get(small).open().read(), b'abc')
+
+        os.remove(small)
+        os.remove(large)
+
+    def test_hosted_files(self):
+
+        print('***** Test hosted files ***')
+
+        import hook
+        from hook import configure, load_button, get_push_details, get_hosted_url, post_update
+
+        settings = configure('settings.yaml')
+        context = load_button(settings, name='incident')
+
+        # no public url
+        self.assertEqual(get_hosted_url(context, 'files/spark.png'), None)
+
+        context['server']['url'] = 'http://localhost/'
+        hook.hosted_files.clear()
+
+        url = get_hosted_url(context, 'files/spark.png')
+        self.assertTrue(url.startswith('http://localhost/files/spark.png?'))
+        self.assertEqual(get_hosted_url(context, 'files/spark.png'), url)
+        self.assertEqual(len(hook.hosted_files), 1)
+
+        # other file, other url
+        self.assertNotEqual(get_hosted_url(context, 'files/dashboard.png'), url)
+
+        # file is referenced, and not uploaded
+        update, phone = get_push_details(context, 5)
+        self.assertEqual(update['files'], url)
+
+        context['spark']['id'] = '*id*'
+        with mock.patch('requests.Session.request', return_value=FakeResponse()) as request:
+            post_update(context, update)
+            self.assertEqual(request.call_args[1]['data']['files'], url)
+
+        # file is uploaded if Cisco Spark cannot fetch it
+        with mock.patch('requests.Session.request',
+                        side_effect=[FakeResponse(status_code=400), FakeResponse()]) as request:
+            post_update(context, get_push_details(context, 5)[0])
+            self.assertEqual(request.call_count, 2)
+            self.assertTrue(request.call_args[1]['headers']['Content-Type'].startswith('multipart/form-data'))
+
+        self.assertEqual(get_hosted_url(context, 'files/spark.png'), None)
+        update, phone = get_push_details(context, 5)
+        self.assertTrue(isinstance(update['files'], tuple))
+
+        # feature can be disabled
+        context['server']['hosted_files'] = False
+        update, phone = get_push_details(context, 5)
+        self.assertTrue(isinstance(update['files'], tuple))
+
+        context['server']['url'] = None
+        del context['server']['hosted_files']
+        hook.hosted_files.clear()
 
     def test_push_details(self):
 
@@ -383,6 +1690,88 @@ class HookTests(unittest.TestCase):
             hash = 'forged_hash'
             decode_token(settings, base64.b64encode(settings['name']+':'+hash))
 
+    def test_incremental_tokens(self):
+
+        print('***** Test incremental tokens ***')
+
+        import hook
+        from hook import configure, load_buttons, load_button, decode_token
+
+        settings = configure('settings.yaml')
+        settings['server']['key'] = 'a_secret'
+
+        with mock.patch('hook.save_tokens', side_effect=hook.save_tokens) as save_tokens, \
+             mock.patch('hook.encode_token', side_effect=hook.encode_token) as encode_token:
+
+            # tokens are saved once for all buttons
+            buttons = load_buttons(settings)
+            self.assertEqual(save_tokens.call_count, 1)
+            self.assertEqual(encode_token.call_count, 4*len(buttons)+1)
+
+            with open(os.path.abspath(os.path.dirname(__file__))+'/../buttons/temporary.yaml', 'w') as handle:
+                handle.write(my_button)
+
+            # only tokens of the new button are computed
+            save_tokens.reset_mock()
+            encode_token.reset_mock()
+            load_button(settings, 'temporary')
+            self.assertEqual(save_tokens.call_count, 1)
+            self.assertEqual(encode_token.call_count, 4+1)
+
+        os.remove(os.path.abspath(os.path.dirname(__file__))+'/../buttons/temporary.yaml')
+
+        self.assertEqual(decode_token(settings, settings['tokens']['temporary-call'], 'call'), 'temporary')
+        self.assertEqual(decode_token(settings, settings['tokens']['incident']), 'incident')
+
+        with open(os.path.abspath(os.path.dirname(__file__))+'/../.tokens', 'r') as handle:
+            self.assertEqual(yaml.load(handle), settings['tokens'])
+
+        hook.buttons.pop('temporary', None)
+
+    def test_token_index(self):
+
+        print('***** Test token index ***')
+
+        import hmac
+        import hook
+        from hook import generate_tokens, decode_token
+
+        settings = {'server': {'key': 'a_secret'}}
+        tokens = generate_tokens(settings, ['incident', 'request'])
+        token = base64.b64encode('unknown:'+base64.b64encode(hmac.new('a_secret', 'unknown').digest()))
+
+        with mock.patch('hook.hmac.new', side_effect=hmac.new) as new:
+
+            # known tokens are not hashed again
+            self.assertEqual(decode_token(settings, tokens['incident']), 'incident')
+            self.assertEqual(decode_token(settings, tokens['request-call'], 'call'), 'request')
+            with self.assertRaises(Exception):
+                decode_token(settings, tokens['incident'], 'delete')
+            self.assertEqual(new.call_count, 0)
+
+            # tokens of unknown buttons are checked
+            self.assertEqual(decode_token(settings, token), 'unknown')
+            self.assertEqual(new.call_count, 1)
+
+            # rejected tokens are not hashed again
+            hook.rejected_tokens.clear()
+            forged = base64.b64encode('incident:forged_hash')
+            with self.assertRaises(Exception):
+                decode_token(settings, forged)
+            self.assertEqual(new.call_count, 2)
+            with self.assertRaises(Exception):
+                decode_token(settings, forged)
+            self.assertEqual(new.call_count, 2)
+
+            # the cache of rejected tokens is bounded
+            settings['server']['rejected_tokens'] = 3
+            for index in range(5):
+                with self.assertRaises(Exception):
+                    decode_token(settings, 'forged_{}'.format(index))
+            self.assertEqual(len(hook.rejected_tokens), 3)
+
+        hook.rejected_tokens.clear()
+
     def test_generate_tokens(self):
 
         print('***** Test generate tokens ***')